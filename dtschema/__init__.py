@@ -14,6 +14,7 @@ from dtschema.lib import (
     _is_string_schema,
     _get_array_range,
     sized_int,
+    sized_array,
 )
 
 from dtschema.fixups import (
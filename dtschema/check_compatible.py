@@ -3,29 +3,52 @@
 # Copyright 2022 Arm Ltd.
 
 import os
+import sys
 import argparse
 
 import dtschema
 
 
+def read_compatibles(f):
+    return [line.strip() for line in f if line.strip()]
+
+
 def main():
     ap = argparse.ArgumentParser(fromfile_prefix_chars='@',
         epilog='Arguments can also be passed in a file prefixed with a "@" character.')
-    ap.add_argument("compatible_str", nargs='+',
-                    help="1 or more compatible strings to check for a match")
+    ap.add_argument("compatible_str", nargs='*',
+                    help="compatible strings to check for a match. If none are given or with -f, "
+                         "they are read one per line from standard input")
+    ap.add_argument('-f', '--file',
+                    help="file of compatible strings to check, one per line ('-' for standard input)")
     ap.add_argument('-q', '--quiet', action="store_true",
                     help="Suppress printing matches")
     ap.add_argument('-v', '--invert-match', action="store_true",
                     help="invert sense of matching, printing compatible which don't match")
     ap.add_argument('-V', '--version', help="Print version number",
                     action="version", version=dtschema.__version__)
-    ap.add_argument('-s', '--schema', required=True, help="path to processed schema file or schema directory")
+    ap.add_argument('-s', '--schema', required=True,
+                    help="path to processed schema file, schema directory or compatible index from 'dt-mk-schema -c'")
     args = ap.parse_args()
 
     if args.schema != "" and not os.path.exists(args.schema):
         exit(-1)
 
-    undoc_compats = dtschema.DTValidator([args.schema]).get_undocumented_compatibles(args.compatible_str)
+    compatibles = args.compatible_str
+    if args.file and args.file != '-':
+        with open(args.file, 'r', encoding='utf-8') as f:
+            compatibles += read_compatibles(f)
+    elif args.file or not compatibles:
+        compatibles += read_compatibles(sys.stdin)
+
+    if dtschema.validator.is_compatible_index(args.schema):
+        matcher = dtschema.validator.compatible_matcher.load(args.schema)
+    else:
+        matcher = dtschema.DTValidator([args.schema]).get_compatible_matcher()
+
+    # Duplicates are only printed once, in the order given
+    compatibles = list(dict.fromkeys(compatibles))
+    undoc_compats = matcher.get_undocumented(compatibles)
 
     if args.invert_match:
         if len(undoc_compats) > 0:
@@ -33,7 +56,8 @@ def main():
                 print(*undoc_compats, sep="\n")
             return 0
     else:
-        matches = set(args.compatible_str).difference(undoc_compats)
+        undoc = set(undoc_compats)
+        matches = [c for c in compatibles if c not in undoc]
         if len(matches) > 0:
             if not args.quiet:
                 print(*matches, sep="\n")
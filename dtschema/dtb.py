@@ -55,15 +55,22 @@ def bytes_to_string(b):
 
 def get_stride(prop_len, dim):
 
-    # If multiple dimensions, check if one and only one dimension fits
-    match = []
-    for outer in range(dim[0][0], dim[0][1] + 1):
-        for inner in range(dim[1][0], dim[1][1] + 1):
-            if outer * inner == prop_len:
-                match += [inner]
-
-    if len(match) > 0:
-        return match[0]
+    # If multiple dimensions, use the inner dimension of the smallest outer
+    # dimension which fits. Only divisors of the length can fit.
+    if prop_len > 0:
+        match = None
+        d = 1
+        while d * d <= prop_len:
+            if not prop_len % d:
+                for outer in (d, prop_len // d):
+                    inner = prop_len // outer
+                    if dim[0][0] <= outer <= dim[0][1] and dim[1][0] <= inner <= dim[1][1] and \
+                       (match is None or outer < match[0]):
+                        match = (outer, inner)
+            d += 1
+
+        if match:
+            return match[1]
 
     if dim[1][0] > 0 and dim[1][0] == dim[1][1]:
         return dim[1][0]
@@ -73,43 +80,42 @@ def get_stride(prop_len, dim):
 
     return prop_len
 
-def prop_value(validator, nodename, p):
-    # First, check for a boolean type
-    if not len(p):
-        return True
 
-    dim = None
-    data = bytes(p)
-    fmt = None
+def get_decode_plan(validator, propname, length):
+    '''Work out how to decode a property from its name and length
 
-    if nodename in {'__fixups__', 'aliases'}:
-        return data[:-1].decode(encoding='ascii').split('\0')
+    Returns how to try decoding the value as strings first, if at all, and
+    then how to decode it otherwise. None for the latter means the raw data
+    is returned.
+    '''
+    fmt = None
+    pre = None
 
-    prop_types = set(validator.property_get_type(p.name))
+    prop_types = set(validator.property_get_type(propname))
     prop_types -= {'node'}
 
     # Filter out types impossible for the size of the property
     if len(prop_types) > 1:
-        if len(p) % 8:
+        if length % 8:
             prop_types -= {'int64', 'uint64', 'int64-array', 'uint64-array'}
-        if len(p) % 4:
+        if length % 4:
             prop_types -= {'int32', 'uint32', 'int32-array', 'uint32-array', 'phandle', 'phandle-array'}
-        if len(p) % 2:
+        if length % 2:
             prop_types -= {'int16', 'uint16', 'int16-array', 'uint16-array'}
 
-        if len(p) > 4:
+        if length > 4:
             prop_types -= {'int32', 'uint32', 'phandle'}
         else:
             prop_types -= {'int64', 'uint64', 'int64-array', 'uint64-array'}
-        if len(p) > 2:
+        if length > 2:
             prop_types -= {'int16', 'uint16'}
         else:
             prop_types -= {'int32', 'uint32', 'int32-array', 'uint32-array', 'phandle', 'phandle-array'}
-        if len(p) > 1:
+        if length > 1:
             prop_types -= {'int8', 'uint8'}
         else:
             prop_types -= {'int16', 'uint16', 'int16-array', 'uint16-array'}
-        if len(p) > 0:
+        if length > 0:
             prop_types -= {'flag'}
 
         if prop_types >= {'phandle', 'phandle-array'}:
@@ -125,34 +131,32 @@ def prop_value(validator, nodename, p):
         if prop_types >= {'int8', 'uint8'}:
             prop_types -= {'uint8'}
 
-    dim = validator.property_get_type_dim(p.name)
+    dim = validator.property_get_type_dim(propname)
     matrix_prop_types = { t for t in prop_types if 'matrix' in t }
 
     if len(prop_types) > 1:
         if {'string', 'string-array'} & prop_types:
-            str = bytes_to_string(data)
-            if str:
-                return str
+            pre = 'strings'
             # Assuming only one other type
             try:
                 fmt = prop_types.difference({'string', 'string-array'}).pop()
             except:
-                return data
+                return pre, None
         elif matrix_prop_types:
             scalar_prop_types = prop_types - matrix_prop_types
             if len(scalar_prop_types) == 1:
                 fmt = scalar_prop_types.pop()
                 min_dim = dim[0][0] * dim[1][0]
-                if len(p) / type_format[fmt].size >= min_dim:
+                if length / type_format[fmt].size >= min_dim:
                     fmt = matrix_prop_types.pop()
         else:
-            #print(p.name + ': multiple types found', file=sys.stderr)
+            #print(propname + ': multiple types found', file=sys.stderr)
             # HACK around type collisions.
-            if p.name == "dma-masters":
+            if propname == "dma-masters":
                 # Default for phandles, and then fixup later when we can more
                 # reliably detect what is or isn't a phandle in fixup_handles()
                 fmt = 'phandle-array'
-            elif p.name == "mode-gpios":
+            elif propname == "mode-gpios":
                 # "mode-gpios" also matches "^mode-" pattern, but it is always a GPIO
                 fmt = 'phandle-array'
             else:
@@ -162,66 +166,120 @@ def prop_value(validator, nodename, p):
 
     if not fmt:
         # Primarily for aliases properties
+        pre = 'ascii'
+        if not length % 4:
+            fmt = 'uint32-array'
+        else:
+            #print(propname + ': no type found', file=sys.stderr)
+            return pre, None
+
+    if fmt.startswith('string'):
+        return pre, ('string',)
+
+    if 'flag' in prop_types and fmt == 'flag':
+        return pre, ('flag',)
+
+    error_fmt = None
+    try:
+        type_struct = type_format[fmt.split('-', 1)[0]]
+        if length % type_struct.size:
+            error_fmt = fmt
+    except KeyError:
+        error_fmt = fmt
+
+    if error_fmt:
+        if length == 4:
+            type_struct = type_format['uint32']
+        elif length == 2:
+            type_struct = type_format['uint16']
+        elif length == 1:
+            type_struct = type_format['uint8']
+        else:
+            return pre, ('size-error', error_fmt)
+
+    count = length // type_struct.size
+    # Unpack all the values at once
+    values_struct = struct.Struct('>%d%s' % (count, type_struct.format[-1]))
+    if 'matrix' in fmt or fmt in {'phandle', 'phandle-array', 'address'}:
+        shape = 'matrix'
+        stride = get_stride(count, dim) if dim else count
+    elif 'array' not in fmt and count == 1:
+        shape = 'scalar'
+        stride = None
+    else:
+        shape = 'array'
+        stride = None
+
+    return pre, ('int', values_struct, type_struct.size * 8, error_fmt, shape, stride)
+
+
+def prop_value(validator, nodename, name, data):
+    '''Decode a property value from any bytes-like object
+
+    Integers are unpacked straight from data, so only string and undecoded
+    values are copied.
+    '''
+    # First, check for a boolean type
+    if not len(data):
+        return True
+
+    if nodename in {'__fixups__', 'aliases'}:
+        return bytes(data[:-1]).decode(encoding='ascii').split('\0')
+
+    # How to decode a property only depends on its name and length
+    key = (name, len(data))
+    try:
+        pre, plan = validator.prop_decode_cache[key]
+    except KeyError:
+        pre, plan = validator.prop_decode_cache[key] = get_decode_plan(validator, name, len(data))
+
+    if pre == 'strings':
+        str = bytes_to_string(bytes(data))
+        if str:
+            return str
+    elif pre == 'ascii':
         try:
-            s = data.decode(encoding='ascii')
+            s = bytes(data).decode(encoding='ascii')
             if s.endswith('\0'):
                 s = s[:-1]
                 if s.isprintable():
                     return [s]
         except:
             pass
-        if not len(data) % 4:
-            fmt = 'uint32-array'
-        else:
-            #print(p.name + ': no type found', file=sys.stderr)
-            return data
 
-    if fmt.startswith('string'):
+    if not plan:
+        return bytes(data)
+
+    action = plan[0]
+    if action == 'string':
+        data = bytes(data)
         if not data.endswith(b'\0'):
             # Wrong data type?, skip decoding to force errors
             return data
         return data[:-1].decode(encoding='ascii').split('\0')
 
-    if {'flag'} & prop_types:
-        if len(data):
-            if fmt == 'flag':
-                print('{prop}: boolean property with value {val}'.format(prop=p.name, val=data),
-                      file=sys.stderr)
-                return data
-        else:
-            return True
+    if action == 'flag':
+        print('{prop}: boolean property with value {val}'.format(prop=name, val=bytes(data)),
+              file=sys.stderr)
+        return bytes(data)
 
-    val_int = list()
-    #print(p.name, fmt,  bytes(p))
-    try:
-        type_struct = type_format[fmt.split('-', 1)[0]]
-        for i in type_struct.iter_unpack(data):
-            val_int += [dtschema.sized_int(i[0], size=(type_struct.size * 8))]
-    except:
-        print('{prop}: size ({len}) error for type {fmt}'.format(prop=p.name, len=len(p), fmt=fmt), file=sys.stderr)
-        if len(p) == 4:
-            type_struct = type_format['uint32']
-        elif len(p) == 2:
-            type_struct = type_format['uint16']
-        elif len(p) == 1:
-            type_struct = type_format['uint8']
-        else:
-            return data
-        for i in type_struct.iter_unpack(data):
-            val_int += [dtschema.sized_int(i[0], size=(type_struct.size * 8))]
+    if action == 'size-error':
+        print('{prop}: size ({len}) error for type {fmt}'.format(prop=name, len=len(data), fmt=plan[1]), file=sys.stderr)
+        return bytes(data)
 
-    if 'matrix' in fmt or fmt in {'phandle', 'phandle-array', 'address'}:
-        if dim:
-            stride = get_stride(len(val_int), dim)
+    values_struct, size, error_fmt, shape, stride = plan[1:]
+    if error_fmt:
+        print('{prop}: size ({len}) error for type {fmt}'.format(prop=name, len=len(data), fmt=error_fmt), file=sys.stderr)
 
-            #print(p.name, dim, stride, len(val_int))
-            return [val_int[i:i+stride] for i in range(0, len(val_int), stride)]
-        else:
-            return [val_int]
-    elif 'array' not in fmt and len(val_int) == 1:
-        return val_int[0]
+    val_int = values_struct.unpack(data)
 
-    return val_int
+    if shape == 'matrix':
+        #print(name, stride, len(val_int))
+        return [dtschema.sized_array(val_int[i:i+stride], size=size) for i in range(0, len(val_int), stride)]
+    elif shape == 'scalar':
+        return dtschema.sized_int(val_int[0], size=size)
+
+    return dtschema.sized_array(val_int, size=size)
 
 
 def node_props(validator, fdt, nodename, offset):
@@ -229,28 +287,34 @@ def node_props(validator, fdt, nodename, offset):
     poffset = fdt.first_property_offset(offset, QUIET_NOTFOUND)
     while poffset >= 0:
         p = fdt.get_property_by_offset(poffset)
-        props_dict[p.name] = prop_value(validator, nodename, p)
+        props_dict[p.name] = prop_value(validator, nodename, p.name, bytes(p))
 
         poffset = fdt.next_property_offset(poffset, QUIET_NOTFOUND)
 
     return props_dict
 
 
-phandles = {}
-phandle_loc = []
+class decode_context():
+    '''State for decoding a single DTB'''
+    def __init__(self, lazy=False):
+        # Create lazy_node nodes rather than decoding properties up front
+        self.lazy = lazy
+        # Set once the whole DTB is scanned and lazy_node fixups can be done
+        self.scanned = False
+        # Nodes by phandle value
+        self.phandles = {}
+        # Locations of phandles in the DTB's fixups as 'path:property:offset'
+        self.phandle_locs = set()
 
 
-def process_fixups(validator, fdt, nodename, offset):
+def process_fixups(ctx, validator, fdt, nodename, offset):
     if nodename != '__fixups__':
         return
     props = node_props(validator, fdt, nodename, offset)
-    global phandle_loc
-    phandle_loc += [s for l in props.values() for s in l]
-
+    ctx.phandle_locs.update(s for l in props.values() for s in l)
 
-def process_local_fixups(fdt, nodename, path, offset):
-    global phandle_loc
 
+def process_local_fixups(ctx, fdt, nodename, path, offset):
     if nodename:
         path += '/' + nodename
 
@@ -259,37 +323,52 @@ def process_local_fixups(fdt, nodename, path, offset):
         p = fdt.get_property_by_offset(poffset)
 
         for i in type_format['uint32'].iter_unpack(bytes(p)):
-            phandle_loc += [path + ':' + p.name + ':' + str(i[0])]
+            ctx.phandle_locs.add(path + ':' + p.name + ':' + str(i[0]))
 
         poffset = fdt.next_property_offset(poffset, QUIET_NOTFOUND)
 
     offset = fdt.first_subnode(offset, QUIET_NOTFOUND)
     while offset >= 0:
         nodename = fdt.get_name(offset)
-        process_local_fixups(fdt, nodename, path, offset)
+        process_local_fixups(ctx, fdt, nodename, path, offset)
 
         offset = fdt.next_subnode(offset, QUIET_NOTFOUND)
 
 
-def fdt_scan_node(validator, fdt, nodename, offset):
+def fdt_scan_props(ctx, validator, fdt, nodename, offset, parent=None):
+    '''Decode the properties of a node without its subnodes'''
+    if ctx.lazy:
+        node_dict = lazy_node(ctx, validator, nodename, parent)
+        poffset = fdt.first_property_offset(offset, QUIET_NOTFOUND)
+        while poffset >= 0:
+            p = fdt.get_property_by_offset(poffset)
+            node_dict.add_prop(p.name, bytes(p))
+            poffset = fdt.next_property_offset(poffset, QUIET_NOTFOUND)
+    else:
+        node_dict = node_props(validator, fdt, nodename, offset)
+    if 'phandle' in node_dict:
+        #print('phandle', node_dict['phandle'])
+        ctx.phandles[node_dict['phandle']] = node_dict
+
+    return node_dict
+
+
+def fdt_scan_node(ctx, validator, fdt, nodename, offset, parent=None):
     if nodename == '__fixups__':
-        process_fixups(validator, fdt, nodename, offset)
+        process_fixups(ctx, validator, fdt, nodename, offset)
         return
     if nodename == '__local_fixups__':
-        process_local_fixups(fdt, '', '', offset)
+        process_local_fixups(ctx, fdt, '', '', offset)
         return
     if nodename.startswith('__'):
         return
 
-    node_dict = node_props(validator, fdt, nodename, offset)
-    if 'phandle' in node_dict:
-        #print('phandle', node_dict['phandle'])
-        phandles[node_dict['phandle']] = node_dict
+    node_dict = fdt_scan_props(ctx, validator, fdt, nodename, offset, parent)
 
     offset = fdt.first_subnode(offset, QUIET_NOTFOUND)
     while offset >= 0:
         nodename = fdt.get_name(offset)
-        node = fdt_scan_node(validator, fdt, nodename, offset)
+        node = fdt_scan_node(ctx, validator, fdt, nodename, offset, node_dict)
         if node is not None:
             node_dict[nodename] = node
 
@@ -298,6 +377,249 @@ def fdt_scan_node(validator, fdt, nodename, offset):
     return node_dict
 
 
+class phandle_table(dict):
+    '''Nodes by phandle value, also finding nodes which aren't decoded
+
+    Used when only part of a DTB is decoded, so that phandles to nodes
+    elsewhere still resolve. Such nodes are decoded without their subnodes
+    when they're first looked up.
+    '''
+    def __init__(self, validator, fdt):
+        super().__init__()
+        self.validator = validator
+        self.fdt = fdt
+
+    def find(self, phandle):
+        node = dict.get(self, phandle)
+        if node is not None or not isinstance(phandle, int):
+            return node
+
+        offset = self.fdt.node_offset_by_phandle(phandle, (libfdt.NOTFOUND, libfdt.BADPHANDLE))
+        if offset < 0:
+            return None
+
+        node = node_props(self.validator, self.fdt, self.fdt.get_name(offset), offset)
+        dict.__setitem__(self, phandle, node)
+        return node
+
+    def __contains__(self, phandle):
+        return self.find(phandle) is not None
+
+    def __missing__(self, phandle):
+        node = self.find(phandle)
+        if node is None:
+            raise KeyError(phandle)
+        return node
+
+
+def fdt_get_paths(dtb, paths):
+    '''Get the full path of the node at each of paths, or None if not found
+
+    As with libfdt, a path can start with an alias and leave out unit
+    addresses which aren't needed to find the node.
+    '''
+    fdt = libfdt.Fdt(dtb)
+    full_paths = []
+    for path in paths:
+        offset = fdt.path_offset(path, (libfdt.NOTFOUND, libfdt.BADPATH))
+        full_paths.append(fdt.get_path(offset) if offset >= 0 else None)
+
+    return full_paths
+
+
+def fdt_scan_paths(ctx, validator, fdt, paths):
+    '''Decode only the subtrees at paths
+
+    The nodes above each subtree are decoded without their other subnodes
+    as fixups need their properties. Other nodes are only decoded if
+    they're looked up by phandle.
+    '''
+    full_paths = []
+    for path in sorted({fdt.get_path(fdt.path_offset(path)) for path in paths}):
+        # Subtrees within another subtree are already decoded
+        if not any(path.startswith(p.rstrip('/') + '/') for p in full_paths):
+            full_paths.append(path)
+
+    ctx.phandles = phandle_table(validator, fdt)
+
+    if full_paths == ['/']:
+        root = fdt_scan_node(ctx, validator, fdt, '/', 0)
+    else:
+        root = fdt_scan_props(ctx, validator, fdt, '/', 0)
+
+    for path in full_paths:
+        node = root
+        offset = 0
+        names = path.split('/')[1:]
+        for nodename in names[:-1]:
+            offset = fdt.subnode_offset(offset, nodename)
+            if nodename not in node:
+                node[nodename] = fdt_scan_props(ctx, validator, fdt, nodename, offset, node)
+            node = node[nodename]
+
+        nodename = names[-1]
+        if not nodename:
+            continue
+        offset = fdt.subnode_offset(offset, nodename)
+        subtree = fdt_scan_node(ctx, validator, fdt, nodename, offset, node)
+        if subtree is not None:
+            node[nodename] = subtree
+
+    # Fixups data applies to the whole tree
+    for nodename in ['__fixups__', '__local_fixups__']:
+        offset = fdt.subnode_offset(0, nodename, QUIET_NOTFOUND)
+        if offset >= 0:
+            fdt_scan_node(ctx, validator, fdt, nodename, offset)
+
+    return root
+
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+fdt_header = struct.Struct('>10L')
+fdt_prop = struct.Struct('>LL')
+
+# How nodes are handled by fdt_walk(), matching fdt_scan_node()
+_NODE, _FIXUPS, _LOCAL_FIXUPS, _SKIP = range(4)
+
+
+def fdt_walk(ctx, validator, dtb):
+    '''Decode a DTB by walking its structure block directly
+
+    This is an alternative to fdt_scan_node() which doesn't go through libfdt.
+    dtb can be any buffer (bytes, mmap, ...) and property values are decoded
+    from slices of a memoryview of it, so nothing is copied for integer
+    values. Property names are looked up in the strings block once per DTB.
+    '''
+    if not hasattr(dtb, 'find'):
+        dtb = bytes(dtb)
+    blob = memoryview(dtb)
+
+    if len(blob) < fdt_header.size:
+        raise libfdt.FdtException(-libfdt.TRUNCATED)
+    magic, totalsize, off_struct, off_strings, _, version, last_comp_version, _, \
+        size_strings, size_struct = fdt_header.unpack_from(blob)
+    if magic != FDT_MAGIC:
+        raise libfdt.FdtException(-libfdt.BADMAGIC)
+    if version < 17 or last_comp_version > 17:
+        raise libfdt.FdtException(-libfdt.BADVERSION)
+    if totalsize > len(blob) or off_struct + size_struct > totalsize or \
+       off_strings + size_strings > totalsize:
+        raise libfdt.FdtException(-libfdt.TRUNCATED)
+
+    strings = bytes(blob[off_strings:off_strings + size_strings])
+    names = {}
+
+    u32_unpack = u32.unpack_from
+    prop_unpack = fdt_prop.unpack_from
+    find = dtb.find
+    lazy = ctx.lazy
+
+    root = None
+    # (kind, props, nodename, path) of the current node and its parents
+    node = None
+    stack = []
+    # Node whose phandle is registered once all its properties are decoded
+    pending = None
+
+    pos = off_struct
+    end = off_struct + size_struct
+    while pos < end:
+        tag = u32_unpack(blob, pos)[0]
+        pos += 4
+
+        if tag == FDT_PROP:
+            length, nameoff = prop_unpack(blob, pos)
+            pos += 8
+            data = blob[pos:pos + length]
+            pos = (pos + length + 3) & ~3
+
+            kind = node[0]
+            if kind == _SKIP:
+                continue
+
+            try:
+                name = names[nameoff]
+            except KeyError:
+                name = names[nameoff] = strings[nameoff:strings.index(b'\0', nameoff)].decode()
+
+            if kind == _NODE:
+                if lazy:
+                    node[1].add_prop(name, data)
+                else:
+                    node[1][name] = prop_value(validator, node[2], name, data)
+            elif kind == _FIXUPS:
+                ctx.phandle_locs.update(prop_value(validator, '__fixups__', name, data))
+            else:
+                path = node[3]
+                for i in u32.iter_unpack(data):
+                    ctx.phandle_locs.add(path + ':' + name + ':' + str(i[0]))
+
+        elif tag == FDT_BEGIN_NODE:
+            name_end = find(b'\0', pos)
+            if name_end < 0 or name_end >= end:
+                raise libfdt.FdtException(-libfdt.BADSTRUCTURE)
+            nodename = dtb[pos:name_end].decode()
+            pos = (name_end + 4) & ~3
+
+            if pending is not None:
+                if 'phandle' in pending:
+                    ctx.phandles[pending['phandle']] = pending
+                pending = None
+
+            if node is None:
+                if root is not None:
+                    raise libfdt.FdtException(-libfdt.BADSTRUCTURE)
+                root = pending = lazy_node(ctx, validator, '/') if lazy else {}
+                child = (_NODE, root, '/', '')
+            elif node[0] == _NODE:
+                if nodename == '__fixups__':
+                    child = (_FIXUPS, None, nodename, '')
+                elif nodename == '__local_fixups__':
+                    child = (_LOCAL_FIXUPS, None, nodename, '')
+                elif nodename.startswith('__'):
+                    child = (_SKIP, None, nodename, '')
+                else:
+                    if lazy:
+                        props = lazy_node(ctx, validator, nodename, node[1])
+                    else:
+                        props = {}
+                    node[1][nodename] = pending = props
+                    child = (_NODE, props, nodename, '')
+            elif node[0] == _LOCAL_FIXUPS:
+                child = (_LOCAL_FIXUPS, None, nodename, node[3] + '/' + nodename)
+            else:
+                child = (_SKIP, None, nodename, '')
+
+            stack.append(node)
+            node = child
+
+        elif tag == FDT_END_NODE:
+            if node is None:
+                raise libfdt.FdtException(-libfdt.BADSTRUCTURE)
+            if pending is not None:
+                if 'phandle' in pending:
+                    ctx.phandles[pending['phandle']] = pending
+                pending = None
+            node = stack.pop()
+
+        elif tag == FDT_END:
+            break
+
+        elif tag != FDT_NOP:
+            raise libfdt.FdtException(-libfdt.BADSTRUCTURE)
+
+    if root is None or node is not None:
+        raise libfdt.FdtException(-libfdt.BADSTRUCTURE)
+
+    return root
+
+
 phandle_args = {
     # phandle+args properties with fixed arg size or which don't match standard
     # 'foos' and '#foo-cells' pattern
@@ -326,214 +648,643 @@ def _get_cells_size(node, cellname):
         return 0
 
 
-def _check_is_phandle(prop_path, cell):
-    path = prop_path + ':' + str(cell * 4)
-    return path in phandle_loc
+def _check_is_phandle(ctx, prop_path, cell):
+    return prop_path + ':' + str(cell * 4) in ctx.phandle_locs
 
 
-def _get_phandle_arg_size(prop_path, idx, cells, cellname):
-    if not cells:
+def _get_phandle_arg_size(ctx, prop_path, idx, val, cellname):
+    if idx >= len(val):
         return 0
-    phandle = cells[0]
+    phandle = val[idx]
     if phandle == 0 or not cellname:
         return 1
     if phandle == 0xffffffff:
         # Use fixups data if available (examples)
         # Mixing unresolved and resolved phandles doesn't work
-        if _check_is_phandle(prop_path, idx):
+        if _check_is_phandle(ctx, prop_path, idx):
             cell_count = 1
-            while (cell_count < len(cells)) and not _check_is_phandle(prop_path, idx + cell_count):
+            while (idx + cell_count < len(val)) and not _check_is_phandle(ctx, prop_path, idx + cell_count):
                 cell_count += 1
 
             return cell_count
         else:
             return 0
 
-    if phandle not in phandles:
+    if phandle not in ctx.phandles:
         return 0
 
-    node = phandles[phandle]
+    node = ctx.phandles[phandle]
 
     return _get_cells_size(node, cellname) + 1
 
 
-def fixup_phandles(validator, dt, path=''):
-    for k, v in dt.items():
-        if isinstance(v, dict):
-            fixup_phandles(validator, v, path=path + '/' + k)
-            continue
-        elif not {'phandle-array'} & set(validator.property_get_type(k)):
-            continue
-        elif k != 'dma-masters' and validator.property_has_fixed_dimensions(k):
-            continue
-        elif not isinstance(v, list) or (len(v) > 1 or not isinstance(v[0], list)):
-            # Not a matrix or already split, nothing to do
-            continue
-        elif k in phandle_args:
-            cellname = phandle_args[k]
-        elif k.endswith('s') and 'gpio' not in k:
-            cellname = '#' + k[:-1] + '-cells'
+def _split_cells(val, cells):
+    entries = []
+    i = 0
+    while i < len(val):
+        entries.append(val[i:i + cells])
+        i += cells
+
+    return entries
+
+
+def _fixup_phandle_prop(ctx, validator, path, k, v):
+    if not {'phandle-array'} & set(validator.property_get_type(k)):
+        return v
+    elif k != 'dma-masters' and validator.property_has_fixed_dimensions(k):
+        return v
+    elif not isinstance(v, list) or (len(v) > 1 or not isinstance(v[0], list)):
+        # Not a matrix or already split, nothing to do
+        return v
+    elif k in phandle_args:
+        cellname = phandle_args[k]
+    elif k.endswith('s') and 'gpio' not in k:
+        cellname = '#' + k[:-1] + '-cells'
+        #print(k, v)
+        i = _get_phandle_arg_size(ctx, path + ':' + k, 0, v[0], cellname)
+        if i == 0:
+            return v
+    else:
+        return v
+
+    # HACK around a type collision. Check if the phandle value points
+    # to a DMA provider node or not. If not, then it's a uint32, not a
+    # phandle.
+    phandle = v[0][0]
+    if k == 'dma-masters' and (phandle >= 1 and phandle <= 4) and \
+       (phandle not in ctx.phandles or cellname not in ctx.phandles[phandle]):
+        return phandle
+
+    i = 0
+    entries = []
+    val = v[0]
+    #print(k, v)
+    while i < len(val):
+        #print(k, v, file=sys.stderr)
+        cells = _get_phandle_arg_size(ctx, path + ':' + k, i, val, cellname)
+        if cells == 0:
             #print(k, v)
-            i = _get_phandle_arg_size(path + ':' + k, 0, v[0], cellname)
-            if i == 0:
-                continue
-        else:
-            continue
+            break
 
-        # HACK around a type collision. Check if the phandle value points
-        # to a DMA provider node or not. If not, then it's a uint32, not a
-        # phandle.
-        phandle = v[0][0]
-        if k == 'dma-masters' and (phandle >= 1 and phandle <= 4) and \
-           (phandle not in phandles or cellname not in phandles[phandle]):
-            dt[k] = phandle
-            continue
+        # Special case for msi-ranges which has an additional span cell
+        if k == 'msi-ranges':
+            cells += 1
 
-        i = 0
-        dt[k] = []
-        val = v[0]
-        #print(k, v)
-        while i < len(val):
-            #print(k, v, file=sys.stderr)
-            cells = _get_phandle_arg_size(path + ':' + k, i, val[i:], cellname)
-            if cells == 0:
-                #print(k, v)
-                break
+        # Special case for interconnects which is pairs of phandles+args
+        if k == 'interconnects':
+            cells += _get_phandle_arg_size(ctx, path + ':' + k, i + cells, val, cellname)
 
-            # Special case for msi-ranges which has an additional span cell
-            if k == 'msi-ranges':
-                cells += 1
+        entries.append(val[i:i + cells])
+        #print(k, entries, file=sys.stderr)
 
-            # Special case for interconnects which is pairs of phandles+args
-            if k == 'interconnects':
-                cells += _get_phandle_arg_size(path + ':' + k, i + cells, val[i + cells:], cellname)
+        i += cells
 
-            dt[k] += [val[i:i + cells]]
-            #print(k, dt[k], file=sys.stderr)
+    return entries
 
-            i += cells
 
+def _fixup_gpio_prop(ctx, k, v):
+    if not ((k.endswith('-gpios') or k.endswith('-gpio') or k in {'gpio', 'gpios'}) and
+            not k.endswith(',nr-gpios') and isinstance(v, list)):
+        return v
 
-def fixup_gpios(dt):
-    if 'gpio-hog' in dt:
-        return
-    for k, v in dt.items():
-        if isinstance(v, dict):
-            fixup_gpios(v)
-        elif (k.endswith('-gpios') or k.endswith('-gpio') or k in {'gpio', 'gpios'}) and \
-             not k.endswith(',nr-gpios') and \
-             isinstance(v, list):
-            i = 0
-            dt[k] = []
-            val = v[0]
-            while i < len(val):
-                phandle = val[i]
-                if phandle == 0:
-                    cells = 0
-                elif phandle == 0xffffffff:
-                    #print(val, file=sys.stderr)
-                    try:
-                        cells = val.index(0xffffffff, i + 1, -1)
-                    except:
-                        cells = len(val)
-                    #print(cells, file=sys.stderr)
-                    cells -= (i + 1)
-                else:
-                    #print(k, v, file=sys.stderr)
-                    node = phandles[phandle]
-                    cells = _get_cells_size(node, '#gpio-cells')
+    i = 0
+    entries = []
+    val = v[0]
+    while i < len(val):
+        phandle = val[i]
+        if phandle == 0:
+            cells = 0
+        elif phandle == 0xffffffff:
+            #print(val, file=sys.stderr)
+            try:
+                cells = val.index(0xffffffff, i + 1, -1)
+            except:
+                cells = len(val)
+            #print(cells, file=sys.stderr)
+            cells -= (i + 1)
+        else:
+            #print(k, v, file=sys.stderr)
+            node = ctx.phandles[phandle]
+            cells = _get_cells_size(node, '#gpio-cells')
+
+        entries.append(val[i:i + cells + 1])
 
-                dt[k] += [val[i:i + cells + 1]]
+        i += cells + 1
 
-                i += cells + 1
+    return entries
 
 
-def fixup_interrupts(dt, icells):
+def _fixup_interrupt_parent(ctx, dt, icells):
     if 'interrupt-parent' in dt and isinstance(dt['interrupt-parent'], list):
         phandle = dt['interrupt-parent'][0][0]
         if phandle == 0xffffffff:
             del dt['interrupt-parent']
         else:
-            icells = _get_cells_size(phandles[phandle], '#interrupt-cells')
+            icells = _get_cells_size(ctx.phandles[phandle], '#interrupt-cells')
 
-    for k, v in dt.items():
-        if isinstance(v, dict):
-            if '#interrupt-cells' in dt:
-                icells = _get_cells_size(dt, '#interrupt-cells')
-            fixup_interrupts(v, icells)
-        elif k == 'interrupts' and not isinstance(v, bytes):
-            i = 0
-            dt[k] = []
-            val = v[0]
-            while i < len(val):
-                dt[k] += [val[i:i + icells]]
-                i += icells
-        elif k == 'interrupt-map' and not isinstance(v, bytes):
-            imap_icells = _get_cells_size(dt, '#interrupt-cells')
-            ac = _get_cells_size(dt, '#address-cells')
-            i = 0
-            dt[k] = []
-            val = v[0]
-            phandle = val[ac + imap_icells]
-            if phandle == 0xffffffff:
-                # Assume uniform sizes (same interrupt provider)
-                try:
-                    cells = val.index(0xffffffff, ac + imap_icells + 1) - (ac + imap_icells)
-                except ValueError:
-                    cells = len(val)
-                while i < len(val):
-                    dt[k] += [val[i:i + cells]]
-                    i += cells
+    return icells
+
+
+def _fixup_interrupt_prop(ctx, dt, k, v, icells):
+    if k == 'interrupts' and not isinstance(v, bytes):
+        return _split_cells(v[0], icells)
+    elif k == 'interrupt-map' and not isinstance(v, bytes):
+        imap_icells = _get_cells_size(dt, '#interrupt-cells')
+        ac = _get_cells_size(dt, '#address-cells')
+        val = v[0]
+        phandle = val[ac + imap_icells]
+        if phandle == 0xffffffff:
+            # Assume uniform sizes (same interrupt provider)
+            try:
+                cells = val.index(0xffffffff, ac + imap_icells + 1) - (ac + imap_icells)
+            except ValueError:
+                cells = len(val)
+            return _split_cells(val, cells)
+        else:
+            p_icells = _get_cells_size(ctx.phandles[phandle], '#interrupt-cells')
+            if '#address-cells' in ctx.phandles[phandle]:
+                p_ac = _get_cells_size(ctx.phandles[phandle], '#address-cells')
             else:
-                while i < len(val):
-                    p_icells = _get_cells_size(phandles[phandle], '#interrupt-cells')
-                    if '#address-cells' in phandles[phandle]:
-                        p_ac = _get_cells_size(phandles[phandle], '#address-cells')
-                    else:
-                        p_ac = 0
+                p_ac = 0
+
+            return _split_cells(val, ac + imap_icells + 1 + p_ac + p_icells)
+
+    return v
+
+
+def _fixup_address_prop(validator, dt, k, v, ac, sc):
+    if 'address' in validator.property_get_type(k):
+        return _split_cells(v[0], ac + sc)
+    elif k in {'ranges', 'dma-ranges'} and not isinstance(v, bool):
+        child_cells = _get_cells_size(dt, '#address-cells')
+        child_cells += _get_cells_size(dt, '#size-cells')
+        return _split_cells(v[0], ac + child_cells)
 
-                    cells = ac + imap_icells + 1 + p_ac + p_icells
-                    dt[k] += [val[i:i + cells]]
-                    i += cells
+    return v
 
 
-def fixup_addresses(validator, dt, ac, sc):
+def _fixup_prop(ctx, validator, dt, path, k, v, ac, sc, icells, gpios):
+    if gpios:
+        v = _fixup_gpio_prop(ctx, k, v)
+    v = _fixup_interrupt_prop(ctx, dt, k, v, icells)
+    v = _fixup_address_prop(validator, dt, k, v, ac, sc)
+    return _fixup_phandle_prop(ctx, validator, path, k, v)
+
+
+def fixup_tree(ctx, validator, dt, path='', ac=2, sc=1, icells=1, gpios=True):
+    '''Split the cells of properties in a tree in a single walk
+
+    Each property has the gpio, interrupt, address and phandle fixups done
+    in turn. The '#*-cells' values used are inherited from parent nodes as
+    the walk descends.
+    '''
+    gpios = gpios and 'gpio-hog' not in dt
+    icells = _fixup_interrupt_parent(ctx, dt, icells)
+
     for k, v in dt.items():
         if isinstance(v, dict):
+            if '#interrupt-cells' in dt:
+                icells = _get_cells_size(dt, '#interrupt-cells')
             if '#address-cells' in dt:
-                ac = _get_cells_size(dt,'#address-cells')
+                ac = _get_cells_size(dt, '#address-cells')
             if '#size-cells' in dt:
                 sc = _get_cells_size(dt, '#size-cells')
-            fixup_addresses(validator, v, ac, sc)
-        elif 'address' in validator.property_get_type(k):
-            i = 0
-            dt[k] = []
-            val = v[0]
-            while i < len(val):
-                dt[k] += [val[i:i + ac + sc]]
-                i += ac + sc
-        elif k in {'ranges', 'dma-ranges'} and not isinstance(v, bool):
-            child_cells = _get_cells_size(dt, '#address-cells')
-            child_cells += _get_cells_size(dt, '#size-cells')
-            i = 0
-            dt[k] = []
-            val = v[0]
-            while i < len(val):
-                dt[k] += [val[i:i + ac + child_cells]]
-                i += ac + child_cells
-
-
-def fdt_unflatten(validator, dtb):
-    fdt = libfdt.Fdt(dtb)
+            fixup_tree(ctx, validator, v, path + '/' + k, ac, sc, icells, gpios)
+            continue
+
+        dt[k] = _fixup_prop(ctx, validator, dt, path, k, v, ac, sc, icells, gpios)
+
+
+# Value of lazy_node properties which aren't decoded yet
+_undecoded = object()
+
 
-    offset = fdt.first_subnode(-1, QUIET_NOTFOUND)
-    dt = fdt_scan_node(validator, fdt, '/', offset)
+class lazy_node(dict):
+    '''A node whose properties are decoded on first access
 
-    #print(phandle_loc)
-    fixup_gpios(dt)
-    fixup_interrupts(dt, 1)
-    fixup_addresses(validator, dt, 2, 1)
-    fixup_phandles(validator, dt)
+    Properties are added with add_prop() while scanning a DTB and kept as raw
+    bytes. Once the whole DTB is scanned, accessing a property decodes it and
+    does the same fixups as fixup_tree(), looking up the inherited
+    '#*-cells' values from the parent nodes as needed. Anything needing all
+    the values, such as items(), comparison or repr(), decodes them all.
+    '''
+    __slots__ = ('ctx', 'validator', 'name', 'parent', 'path', 'raw', 'fixup_args')
+
+    def __init__(self, ctx, validator, name, parent=None):
+        super().__init__()
+        self.ctx = ctx
+        self.validator = validator
+        self.name = name
+        self.parent = parent
+        self.path = '' if parent is None else parent.path + '/' + name
+        # Raw data by property name, or a 1-tuple of the value decoded
+        # without fixups
+        self.raw = {}
+        self.fixup_args = None
+
+    def add_prop(self, name, data):
+        if len(data) and self.name != 'aliases':
+            key = (name, len(data))
+            try:
+                pre, plan = self.validator.prop_decode_cache[key]
+            except KeyError:
+                pre, plan = self.validator.prop_decode_cache[key] = get_decode_plan(self.validator, name, len(data))
+
+            # Decode properties which print a warning now rather than on
+            # access. 'phandle' is needed to find nodes while scanning and
+            # an unresolved 'interrupt-parent' is dropped as fixup_tree()
+            # would.
+            if name in {'phandle', 'interrupt-parent'} or \
+               (plan and (plan[0] in {'flag', 'size-error'} or (plan[0] == 'int' and plan[3]))):
+                value = prop_value(self.validator, self.name, name, data)
+                if name == 'interrupt-parent' and isinstance(value, list) and \
+                   value[0][0] == 0xffffffff:
+                    return
+                data = (value,)
+
+        self.raw[name] = data
+        dict.__setitem__(self, name, _undecoded)
+
+    def get_fixup_args(self):
+        '''Get the '#*-cells' values and gpio flag fixup_tree() would use'''
+        if self.fixup_args is None:
+            parent = self.parent
+            if parent is None:
+                ac, sc, icells, gpios = 2, 1, 1, True
+            else:
+                ac, sc, icells, gpios = parent.get_fixup_args()
+                if '#interrupt-cells' in parent:
+                    icells = _get_cells_size(parent, '#interrupt-cells')
+                if '#address-cells' in parent:
+                    ac = _get_cells_size(parent, '#address-cells')
+                if '#size-cells' in parent:
+                    sc = _get_cells_size(parent, '#size-cells')
+
+            gpios = gpios and 'gpio-hog' not in self
+            # Looking up the interrupt parent may decode 'interrupt-parent'
+            # or come back to this node, which don't depend on icells
+            self.fixup_args = (ac, sc, icells, gpios)
+            self.fixup_args = (ac, sc, _fixup_interrupt_parent(self.ctx, self, icells), gpios)
+
+        return self.fixup_args
+
+    def decode(self, k):
+        v = self.raw[k]
+        if isinstance(v, tuple):
+            v = v[0]
+        else:
+            v = prop_value(self.validator, self.name, k, v)
+
+        if not self.ctx.scanned:
+            # Fixups need the whole tree
+            return v
+
+        v = _fixup_prop(self.ctx, self.validator, self, self.path, k, v, *self.get_fixup_args())
+        dict.__setitem__(self, k, v)
+        return v
+
+    def decode_all(self):
+        for k, v in dict.items(self):
+            if v is _undecoded:
+                self.decode(k)
+
+    def __getitem__(self, k):
+        v = dict.__getitem__(self, k)
+        if v is _undecoded:
+            return self.decode(k)
+        return v
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self[k]
+        return dict.setdefault(self, k, default)
+
+    def pop(self, k, *args):
+        if k in self:
+            self[k]
+        return dict.pop(self, k, *args)
+
+    def items(self):
+        self.decode_all()
+        return dict.items(self)
+
+    def values(self):
+        self.decode_all()
+        return dict.values(self)
+
+    def copy(self):
+        self.decode_all()
+        return dict.copy(self)
+
+    def __eq__(self, other):
+        self.decode_all()
+        if isinstance(other, lazy_node):
+            other.decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self.decode_all()
+        if isinstance(other, lazy_node):
+            other.decode_all()
+        return dict.__ne__(self, other)
+
+    def __repr__(self):
+        self.decode_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+
+def fdt_unflatten(validator, dtb, backend='libfdt', lazy=False, paths=None):
+    '''Decode a DTB into a tree of dicts
+
+    backend is 'libfdt' to read the DTB with pylibfdt or 'python' to walk
+    its structure block directly with fdt_walk(). If lazy is set, the nodes
+    are lazy_node instances which decode properties on first access.
+
+    If paths is set, the tree only has the subtrees at paths and the nodes
+    above them, see fdt_scan_paths(). This needs the libfdt backend.
+    '''
+    ctx = decode_context(lazy)
+
+    if paths:
+        if backend != 'libfdt':
+            raise ValueError('decoding paths needs the libfdt backend')
+        dt = fdt_scan_paths(ctx, validator, libfdt.Fdt(dtb), paths)
+    elif backend == 'python':
+        dt = fdt_walk(ctx, validator, dtb)
+    elif backend == 'libfdt':
+        fdt = libfdt.Fdt(dtb)
+        offset = fdt.first_subnode(-1, QUIET_NOTFOUND)
+        dt = fdt_scan_node(ctx, validator, fdt, '/', offset)
+    else:
+        raise ValueError('unknown FDT backend: ' + backend)
+
+    #print(ctx.phandle_locs)
+    if lazy:
+        ctx.scanned = True
+    else:
+        fixup_tree(ctx, validator, dt)
 
 #    pprint.pprint(dt, compact=True)
     return dt
+
+
+class overlay_base():
+    '''A base DTB decoded once to apply overlays to with fdt_apply_overlay()'''
+    def __init__(self, validator, dtb):
+        self.validator = validator
+        self.fdt = libfdt.Fdt(dtb)
+        self.ctx = decode_context()
+        self.dt = fdt_scan_node(self.ctx, validator, self.fdt, '/', 0)
+        fixup_tree(self.ctx, validator, self.dt)
+
+        # New phandles in overlays are numbered after the base's
+        self.max_phandle = max((p for p in self.ctx.phandles if isinstance(p, int)), default=0)
+
+    def get_path(self, path=None, phandle=None):
+        '''Get the full path of a node in the base by path, alias or phandle'''
+        if phandle is not None:
+            offset = self.fdt.node_offset_by_phandle(phandle)
+        else:
+            offset = self.fdt.path_offset(path)
+        return self.fdt.get_path(offset)
+
+
+def _fdt_raw_node(fdt, offset):
+    # Read a node's raw properties and subnodes as (props, subnodes)
+    props = {}
+    poffset = fdt.first_property_offset(offset, QUIET_NOTFOUND)
+    while poffset >= 0:
+        p = fdt.get_property_by_offset(poffset)
+        props[p.name] = bytearray(p)
+        poffset = fdt.next_property_offset(poffset, QUIET_NOTFOUND)
+
+    subnodes = {}
+    offset = fdt.first_subnode(offset, QUIET_NOTFOUND)
+    while offset >= 0:
+        subnodes[fdt.get_name(offset)] = _fdt_raw_node(fdt, offset)
+        offset = fdt.next_subnode(offset, QUIET_NOTFOUND)
+
+    return props, subnodes
+
+
+def _raw_node_by_path(raw, path):
+    for nodename in path.split('/')[1:]:
+        if nodename:
+            raw = raw[1][nodename]
+    return raw
+
+
+def _adjust_local_phandles(raw, local_fixups, delta):
+    # Renumber the overlay's own phandles and references to them as libfdt
+    # does when applying an overlay
+    props, subnodes = raw
+    for name in ['phandle', 'linux,phandle']:
+        if name in props:
+            u32.pack_into(props[name], 0, u32.unpack_from(props[name])[0] + delta)
+
+    if local_fixups is not None:
+        for name, data in local_fixups[0].items():
+            for offset in u32.iter_unpack(data):
+                u32.pack_into(props[name], offset[0], u32.unpack_from(props[name], offset[0])[0] + delta)
+
+    for nodename, subnode in subnodes.items():
+        _adjust_local_phandles(subnode, local_fixups[1].get(nodename) if local_fixups else None, delta)
+
+
+def fdt_overlay_fragments(base, dtbo):
+    '''Get the fragments of an overlay with its phandles resolved
+
+    Returns a list of the full path in base of each fragment's target and
+    the raw '__overlay__' node to merge into it as (props, subnodes).
+    '''
+    fdt = libfdt.Fdt(dtbo)
+    raw = _fdt_raw_node(fdt, 0)
+
+    _adjust_local_phandles(raw, raw[1].get('__local_fixups__'), base.max_phandle)
+
+    if '__fixups__' in raw[1]:
+        symbols = base.fdt.subnode_offset(0, '__symbols__', QUIET_NOTFOUND)
+        for label, locs in raw[1]['__fixups__'][0].items():
+            if symbols < 0 or base.fdt.getprop(symbols, label, QUIET_NOTFOUND) is None:
+                raise ValueError(f"label '{label}' not found in the base __symbols__")
+            phandle = base.fdt.get_phandle(base.fdt.path_offset(base.fdt.getprop(symbols, label).as_str()))
+            for loc in bytes(locs[:-1]).decode().split('\0'):
+                path, prop, offset = loc.rsplit(':', 2)
+                u32.pack_into(_raw_node_by_path(raw, path)[0][prop], int(offset), phandle)
+
+    fragments = []
+    for nodename, fragment in raw[1].items():
+        if nodename.startswith('__') or '__overlay__' not in fragment[1]:
+            continue
+        if 'target' in fragment[0]:
+            target = base.get_path(phandle=u32.unpack_from(fragment[0]['target'])[0])
+        elif 'target-path' in fragment[0]:
+            target = base.get_path(path=bytes(fragment[0]['target-path'][:-1]).decode())
+        else:
+            raise ValueError(f"{nodename}: no 'target' or 'target-path' property")
+        fragments += [(target, fragment[1]['__overlay__'])]
+
+    return fragments
+
+
+def _fdt_merge_node(fdt, offset, raw):
+    props, subnodes = raw
+    for name, data in props.items():
+        fdt.setprop(offset, name, bytes(data))
+
+    for nodename, subnode in subnodes.items():
+        suboffset = fdt.add_subnode(offset, nodename, (libfdt.EXISTS,))
+        if suboffset == -libfdt.EXISTS:
+            suboffset = fdt.subnode_offset(offset, nodename)
+        _fdt_merge_node(fdt, suboffset, subnode)
+
+
+def fdt_merge_overlay(base, fragments):
+    '''Merge overlay fragments into a copy of the base DTB and decode it all
+
+    This is the same as applying the overlay with libfdt and decoding the
+    result, without sharing anything with the base tree.
+    '''
+    fdt = libfdt.Fdt(base.fdt.as_bytearray())
+    fdt.resize(fdt.totalsize() + 2 * sum(_raw_node_size(raw) for _, raw in fragments))
+    for target, raw in fragments:
+        _fdt_merge_node(fdt, fdt.path_offset(target), raw)
+
+    return fdt_unflatten(base.validator, fdt.as_bytearray())
+
+
+def _raw_node_size(raw):
+    # Upper bound of the space a raw node takes in a DTB
+    props, subnodes = raw
+    size = 8
+    for name, data in props.items():
+        size += 12 + len(name) + 1 + len(data) + 3
+    for nodename, subnode in subnodes.items():
+        size += len(nodename) + 4 + _raw_node_size(subnode)
+    return size
+
+
+# Properties which change how other properties are fixed up, so changing
+# them in a base node could change nodes which are shared with the base
+_overlay_fixup_props = {'interrupt-parent', 'gpio-hog', 'phandle', 'linux,phandle'}
+
+
+def fdt_apply_overlay(base, dtbo):
+    '''Apply an overlay to a base DTB decoded with overlay_base
+
+    The base tree isn't modified. Nodes the overlay doesn't change are
+    shared with the base tree, and only the nodes it changes and the nodes
+    above them are copied. The order of properties and nodes is the same as
+    libfdt gives applying the overlay, with new ones before existing ones.
+
+    If the overlay changes a '#*-cells' or similar property of a node in the
+    base, the nodes referring to it may need fixing up differently, so the
+    whole tree is decoded again with fdt_merge_overlay().
+    '''
+    validator = base.validator
+    fragments = fdt_overlay_fragments(base, dtbo)
+
+    dt = dict(base.dt)
+    # Ids of the nodes which aren't shared with the base
+    new_nodes = {id(dt)}
+
+    ctx = decode_context()
+    ctx.phandles = dict(base.ctx.phandles)
+    ctx.phandle_locs = base.ctx.phandle_locs
+
+    # Properties to fix up once all the overlay is merged
+    new_props = []
+
+    def copy_node(parent, nodename):
+        node = parent[nodename]
+        if id(node) not in new_nodes:
+            node = parent[nodename] = dict(node)
+            new_nodes.add(id(node))
+            if 'phandle' in node:
+                ctx.phandles[node['phandle']] = node
+        return node
+
+    def merge_node(node, names, raw, in_base):
+        props, subnodes = raw
+        nodename = names[-1] if names else '/'
+        added = {}
+        for name, data in props.items():
+            if in_base and (name.startswith('#') or name in _overlay_fixup_props):
+                return False
+            value = prop_value(validator, nodename, name, bytes(data))
+            if name in node:
+                node[name] = value
+            else:
+                added[name] = value
+            new_props.append((node, names, name))
+
+        added_nodes = {}
+        for name, subnode in subnodes.items():
+            if isinstance(node.get(name), dict):
+                if not merge_node(copy_node(node, name), names + [name], subnode, in_base):
+                    return False
+            else:
+                child = added_nodes[name] = {}
+                new_nodes.add(id(child))
+                if not merge_node(child, names + [name], subnode, False):
+                    return False
+                if 'phandle' in child:
+                    ctx.phandles[child['phandle']] = child
+
+        if added or added_nodes:
+            # libfdt adds each property first and each node after the
+            # properties. '$nodename' is added when checking the base, so
+            # stays last.
+            items = list(node.items())
+            node.clear()
+            node.update(reversed(added.items()))
+            node.update((k, v) for k, v in items if not isinstance(v, dict) and k != '$nodename')
+            node.update(reversed(added_nodes.items()))
+            node.update((k, v) for k, v in items if isinstance(v, dict) or k == '$nodename')
+
+        return True
+
+    for target, raw in fragments:
+        names = target.split('/')[1:] if target != '/' else []
+        node = dt
+        for nodename in names:
+            node = copy_node(node, nodename)
+        if not merge_node(node, names, raw, True):
+            return fdt_merge_overlay(base, fragments)
+
+    for node, names, k in new_props:
+        ac, sc, icells, gpios = _get_fixup_args(ctx, dt, names)
+        path = ''.join('/' + n for n in names)
+        node[k] = _fixup_prop(ctx, validator, node, path, k, node[k], ac, sc, icells, gpios)
+
+    return dt
+
+
+def _get_fixup_args(ctx, dt, names):
+    # The '#*-cells' values and gpio flag fixup_tree() uses for the node at
+    # names, which must already be fixed up
+    ac, sc, icells, gpios = 2, 1, 1, True
+    node = dt
+    for nodename in names + [None]:
+        gpios = gpios and 'gpio-hog' not in node
+        icells = _fixup_interrupt_parent(ctx, node, icells)
+        if nodename is None:
+            break
+
+        if '#interrupt-cells' in node:
+            icells = _get_cells_size(node, '#interrupt-cells')
+        if '#address-cells' in node:
+            ac = _get_cells_size(node, '#address-cells')
+        if '#size-cells' in node:
+            sc = _get_cells_size(node, '#size-cells')
+        node = node[nodename]
+
+    return ac, sc, icells, gpios
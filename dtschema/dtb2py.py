@@ -3,6 +3,8 @@
 # Copyright 2022 Arm Ltd.
 
 import argparse
+import glob
+import json
 import os
 import sys
 import pprint
@@ -11,33 +13,89 @@ import dtschema
 
 strict = False
 
+
+def to_json(value):
+    '''Convert a decoded DT value to plain JSON types
+
+    Integers are 32 bits unless wrapped in an object with the size as its
+    key, such as {"$uint8": [1, 2]}. Undecoded values are {"$bytes": "hex"}.
+    Node names can't start with '$', so these can't be mistaken for nodes.
+    '''
+    if isinstance(value, dict):
+        return {k: to_json(v) for k, v in value.items()}
+    if isinstance(value, dtschema.sized_array):
+        values = list.copy(value)
+        return values if value.size == 32 else {f'$uint{value.size}': values}
+    if isinstance(value, dtschema.sized_int):
+        return int(value) if value.size == 32 else {f'$uint{value.size}': int(value)}
+    if isinstance(value, list):
+        return [to_json(v) for v in value]
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    return value
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("dtbfile", type=str, help="Schema directories and/or files")
+    ap.add_argument("dtbs", nargs='+', help="DTB files and/or directories to search for DTBs")
     ap.add_argument('-s', '--schema', help="path to additional additional schema files")
+    ap.add_argument('--path', action='append',
+                    help="only decode the subtree at PATH, which can start with an alias. "
+                         "Can be given more than once.")
+    ap.add_argument('--jsonl', action='store_true',
+                    help="print each DTB as a line of JSON with its filename and tree")
     ap.add_argument('-V', '--version', help="Print version number",
                     action="version", version=dtschema.__version__)
     args = ap.parse_args()
 
-    if not os.path.isfile(args.dtbfile):
-        exit(1)
+    dtb_files = []
+    for d in args.dtbs:
+        if os.path.isdir(d):
+            dtb_files += sorted(glob.glob(d + "/**/*.dtb", recursive=True))
+        elif os.path.isfile(d):
+            dtb_files += [d]
+        else:
+            print(f"{d}: not found", file=sys.stderr)
+            exit(1)
 
     if args.schema:
         schemas = [args.schema]
     else:
         schemas = []
 
-    with open(args.dtbfile, 'rb') as f:
-        dt = dtschema.DTValidator(schemas).decode_dtb(f.read())
+    # Only load the schema once for all the DTBs
+    validator = dtschema.DTValidator(schemas)
 
+    ret = 0
     try:
-        pprint.pprint(dt, compact=True)
-        # flush output here to force SIGPIPE to be triggered
-        # while inside this try block.
-        sys.stdout.flush()
+        for filename in dtb_files:
+            with open(filename, 'rb') as f:
+                dtb = f.read()
+
+            if args.path:
+                full_paths = dtschema.dtb.fdt_get_paths(dtb, args.path)
+                missing = [path for path, full_path in zip(args.path, full_paths) if full_path is None]
+                if missing:
+                    for path in missing:
+                        print(f"{filename}: {path}: node not found", file=sys.stderr)
+                    ret = 1
+                    continue
+
+            dt = validator.decode_dtb(dtb, paths=args.path)
+
+            if args.jsonl:
+                sys.stdout.write(json.dumps({'filename': filename, 'dt': to_json(dt[0])},
+                                            separators=(',', ':')) + '\n')
+            else:
+                pprint.pprint(dt, compact=True)
+            # flush output here to force SIGPIPE to be triggered
+            # while inside this try block.
+            sys.stdout.flush()
     except BrokenPipeError:
         # Python flushes standard streams on exit; redirect remaining output
         # to devnull to avoid another BrokenPipeError at shutdown
         devnull = os.open(os.devnull, os.O_WRONLY)
         os.dup2(devnull, sys.stdout.fileno())
         sys.exit(1)  # Python exits with error code 1 on EPIPE
+
+    sys.exit(ret)
@@ -7,6 +7,21 @@ import sys
 import os
 import argparse
 import glob
+import io
+import json
+import pickle
+import hashlib
+import heapq
+import time
+import socket
+import socketserver
+import shutil
+import signal
+import tempfile
+import traceback
+import collections
+import contextlib
+import multiprocessing
 
 import dtschema
 
@@ -14,6 +29,39 @@ verbose = False
 show_unmatched = False
 match_schema_file = None
 compatible_match = False
+check_paths = None
+node_cache_file = None
+count_only = False
+max_errors = None
+sg = None
+
+# Number of schema sets kept loaded by the validation server
+server_max_schemas = 4
+
+# Seconds the validation server waits for a client to send or receive data
+server_request_timeout = 60
+
+# Number of schemas and nodes listed in the profile report
+profile_max_entries = 50
+
+
+# Stands in for the DTB filename in cached error messages
+cache_filename = '/\0dtb\0'
+
+
+class max_errors_reached(Exception):
+    pass
+
+
+def _node_key(value):
+    # Encode a property value including integer sizes
+    if isinstance(value, dtschema.sized_array):
+        return ('a', value.size) + tuple(list.copy(value))
+    if isinstance(value, list):
+        return ('l',) + tuple(_node_key(v) for v in value)
+    if isinstance(value, dtschema.sized_int):
+        return ('i', value.size, int(value))
+    return value
 
 
 class schema_group():
@@ -23,13 +71,87 @@ class schema_group():
 
         self.validator = dtschema.DTValidator([schema_file])
 
-    def check_node(self, tree, node, disabled, nodename, fullname, filename):
-        # Hack to save some time validating examples
-        if 'example-0' in node or 'example-' in nodename:
+        # Results of checking nodes keyed by the node contents and schemas
+        # applied. Identical nodes in multiple DTBs (e.g. from a common SoC
+        # .dtsi) are then only checked once.
+        self.node_cache = {}
+        self.node_cache_hits = 0
+        self.node_cache_misses = 0
+        # The results used by this run, which are all that's saved
+        self.node_cache_used = None
+        self.schemas_hash = None
+
+        # Digests of the nodes in the DT being checked by node id
+        self.node_digests = {}
+
+        # Errors reported so far, and when checking in a worker the offset in
+        # the captured output after each one
+        self.error_count = 0
+        self.error_ends = None
+
+        # Heap of the slowest nodes to check when profiling
+        self.profile_nodes = None
+
+    def enable_profile(self):
+        self.validator.enable_profile()
+        self.profile_nodes = []
+
+    def get_schemas_hash(self):
+        # Cached results also depend on the code decoding and checking nodes
+        if self.schemas_hash is None:
+            h = hashlib.sha256(dtschema.__version__.encode() + b'\0')
+            h.update(dtschema.validator._get_schema_code_hash().encode() + b'\0')
+            h.update(json.dumps(self.validator.schemas, sort_keys=True, default=repr).encode())
+            self.schemas_hash = h.hexdigest()
+        return self.schemas_hash
+
+    def load_node_cache(self, filename):
+        self.node_cache_used = {}
+        try:
+            with open(filename, 'rb') as f:
+                cache = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
             return
 
-        node['$nodename'] = [nodename]
+        if cache.get('schemas') == self.get_schemas_hash():
+            self.node_cache.update(cache['nodes'])
+
+    def save_node_cache(self, filename):
+        cache = {
+            'schemas': self.get_schemas_hash(),
+            'nodes': self.node_cache_used,
+        }
+        with open(filename, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get_node_digest(self, node):
+        """Get a digest of a node's properties and subnodes
+
+        Subnodes are included by their own digest, so each node is only
+        encoded once. The property order is kept as it affects the order of
+        errors.
+        """
+        digest = self.node_digests.get(id(node))
+        if digest is None:
+            h = hashlib.sha256()
+            for k, v in node.items():
+                if isinstance(v, dict):
+                    h.update(repr(('n', k, self.get_node_digest(v))).encode())
+                else:
+                    h.update(repr(('p', k, _node_key(v))).encode())
+            digest = self.node_digests[id(node)] = h.digest()
+
+        return digest
 
+    def validate_node(self, node, disabled, nodename):
+        """Check a node, returning the errors as a list of records
+
+        The records are 'error' with the formatted message using
+        'cache_filename' for the filename (or None if only counting errors),
+        'unmatched' for a compatible not matching any schema or 'recursion'
+        for a recursion error.
+        """
+        records = []
         try:
             for error in self.validator.iter_errors(node, filter=match_schema_file,
                                                     compatible_match=compatible_match):
@@ -56,22 +178,95 @@ class schema_group():
                             continue
 
                 if error.schema_file == 'generated-compatibles':
-                    if not show_unmatched:
-                        continue
-                    print(f"{filename}: {fullname}: failed to match any schema with compatible: {node['compatible']}",
-                          file=sys.stderr)
+                    records += [('unmatched',)]
+                    continue
+
+                if count_only:
+                    records += [('error', None)]
                     continue
 
                 if 'compatible' in node:
                     compat = node['compatible'][0]
                 else:
                     compat = None
-                print(dtschema.format_error(filename, error, nodename=nodename, compatible=compat, verbose=verbose),
-                    file=sys.stderr)
+                records += [('error', dtschema.format_error(cache_filename, error, nodename=nodename,
+                                                            compatible=compat, verbose=verbose))]
         except RecursionError as e:
-            print(os.path.basename(sys.argv[0]) + ": recursion error: Check for prior errors in a referenced schema", file=sys.stderr)
+            records += [('recursion',)]
 
-    def check_subtree(self, tree, subtree, disabled, nodename, fullname, filename):
+        return records
+
+    def check_node(self, tree, node, disabled, nodename, fullname, filename):
+        # Hack to save some time validating examples
+        if 'example-0' in node or 'example-' in nodename:
+            return
+
+        node['$nodename'] = [nodename]
+        # Any digest from checking the parent was without '$nodename'
+        self.node_digests.pop(id(node), None)
+
+        if self.profile_nodes is not None:
+            # Always check nodes rather than using cached results
+            start = time.perf_counter()
+            records = self.validate_node(node, disabled, nodename)
+            entry = (time.perf_counter() - start, filename, fullname)
+            if len(self.profile_nodes) < profile_max_entries:
+                heapq.heappush(self.profile_nodes, entry)
+            else:
+                heapq.heappushpop(self.profile_nodes, entry)
+            self.print_records(records, node, fullname, filename)
+            return
+
+        schema_ids = self.validator.get_schema_ids(node, filter=match_schema_file,
+                                                   compatible_match=compatible_match)
+        if not schema_ids:
+            # Nothing to check, so don't decode the rest of the node
+            return
+
+        key = hashlib.sha256(repr((self.get_node_digest(node), schema_ids, disabled, verbose,
+                                   count_only)).encode()).digest()
+        records = self.node_cache.get(key)
+        if records is None:
+            self.node_cache_misses += 1
+            records = self.validate_node(node, disabled, nodename)
+            self.node_cache[key] = records
+        else:
+            self.node_cache_hits += 1
+        if self.node_cache_used is not None:
+            self.node_cache_used[key] = records
+
+        self.print_records(records, node, fullname, filename)
+
+    def print_records(self, records, node, fullname, filename):
+        for record in records:
+            if record[0] == 'unmatched' and not show_unmatched:
+                continue
+
+            self.error_count += 1
+            if count_only:
+                pass
+            elif record[0] == 'error':
+                print(record[1].replace(cache_filename, os.path.abspath(filename)), file=sys.stderr)
+            elif record[0] == 'unmatched':
+                print(f"{filename}: {fullname}: failed to match any schema with compatible: {node['compatible']}",
+                      file=sys.stderr)
+            elif record[0] == 'recursion':
+                print(os.path.basename(sys.argv[0]) + ": recursion error: Check for prior errors in a referenced schema", file=sys.stderr)
+
+            if self.error_ends is not None:
+                self.error_ends += [sys.stderr.tell()]
+            if max_errors and self.error_count >= max_errors:
+                raise max_errors_reached()
+
+    def check_subtree(self, tree, subtree, disabled, nodename, fullname, filename, paths=None,
+                      checked=None, skip=None):
+        """Check a node and its subnodes
+
+        If paths is set, only the nodes in the subtrees at the full paths in
+        paths are checked. The disabled state of each node checked is added
+        to checked by node id, and a subtree whose node is in skip with the
+        same disabled state isn't checked.
+        """
         if nodename.startswith('__'):
             return
 
@@ -80,19 +275,356 @@ class schema_group():
         except:
             pass
 
-        self.check_node(tree, subtree, disabled, nodename, fullname, filename)
+        if skip is not None and skip.get(id(subtree)) == disabled:
+            return
+
+        if paths and fullname in paths:
+            paths = None
+        if not paths:
+            self.check_node(tree, subtree, disabled, nodename, fullname, filename)
+            if checked is not None:
+                checked[id(subtree)] = disabled
         if fullname != "/":
             fullname += "/"
-        for name, value in subtree.items():
+        # Only looking for child nodes, so don't decode lazy_node properties
+        for name, value in dict.items(subtree):
             if isinstance(value, dict):
-                self.check_subtree(tree, value, disabled, name, fullname + name, filename)
+                self.check_subtree(tree, value, disabled, name, fullname + name, filename, paths,
+                                   checked, skip)
 
-    def check_dtb(self, filename):
+    def check_dtb(self, filename, dtb=None):
         """Check the given DT against all schemas"""
-        with open(filename, 'rb') as f:
-            dt = self.validator.decode_dtb(f.read())
+        if dtb is None:
+            with open(filename, 'rb') as f:
+                dtb = f.read()
+
+        paths = None
+        if check_paths:
+            paths = []
+            for path, full_path in zip(check_paths, dtschema.dtb.fdt_get_paths(dtb, check_paths)):
+                if full_path is None:
+                    print(f"{filename}: {path}: node not found", file=sys.stderr)
+                else:
+                    paths += [full_path]
+            if not paths:
+                return
+
+        # Verbose errors pretty print nodes, which would show a lazy_node
+        # differently from a dict
+        dt = self.validator.decode_dtb(dtb, lazy=not verbose, paths=paths)
+        self.node_digests = {}
         for subtree in dt:
-            self.check_subtree(dt, subtree, False, "/", "/", filename)
+            self.check_subtree(dt, subtree, False, "/", "/", filename, paths)
+
+    def check_overlays(self, base_filename, filenames):
+        """Check a base DT and then each overlay applied to it
+
+        The base is only decoded once and each overlay is applied to it in
+        memory. Nodes an overlay leaves alone are shared with the base, so
+        only changed nodes, their parents and subtrees whose disabled state
+        changed are checked again, with errors reported against the overlay.
+        """
+        with open(base_filename, 'rb') as f:
+            base = dtschema.dtb.overlay_base(self.validator, f.read())
+
+        # Nodes of the base stay alive with it, so their ids can't be reused
+        base_nodes = {}
+        self.node_digests = {}
+        self.check_subtree([base.dt], base.dt, False, "/", "/", base_filename,
+                           checked=base_nodes)
+
+        for filename in filenames:
+            if verbose:
+                print("Check:  " + filename)
+            with open(filename, 'rb') as f:
+                dtbo = f.read()
+            try:
+                dt = dtschema.dtb.fdt_apply_overlay(base, dtbo)
+            except (ValueError, dtschema.dtb.libfdt.FdtException) as e:
+                print(f"{filename}: failed to apply overlay: {e}", file=sys.stderr)
+                continue
+            # Nodes of earlier overlays are gone, so their ids can be reused
+            self.node_digests = {}
+            self.check_subtree([dt], dt, False, "/", "/", filename, skip=base_nodes)
+
+
+def write_profile(filename):
+    """Write the profile of checking DTBs as text and as JSON to FILE.json"""
+    profile = sg.validator.profile
+
+    schemas = []
+    keywords = {}
+    for schema_id, stats in profile.items():
+        schemas += [{
+            '$id': schema_id,
+            'time': stats['select'][0] + stats['body'][0],
+            'select_time': stats['select'][0],
+            'select_calls': stats['select'][1],
+            'body_time': stats['body'][0],
+            'body_calls': stats['body'][1],
+            'keywords': {k: {'time': v[0], 'calls': v[1]} for k, v in
+                         sorted(stats['keywords'].items(), key=lambda kv: kv[1][0], reverse=True)},
+        }]
+        for k, v in stats['keywords'].items():
+            kw_stats = keywords.setdefault(k, {'time': 0.0, 'calls': 0})
+            kw_stats['time'] += v[0]
+            kw_stats['calls'] += v[1]
+
+    schemas.sort(key=lambda s: s['time'], reverse=True)
+    keywords = dict(sorted(keywords.items(), key=lambda kv: kv[1]['time'], reverse=True))
+    nodes = [{'file': f, 'node': n, 'time': t} for t, f, n in sorted(sg.profile_nodes, reverse=True)]
+
+    with open(filename + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'schemas': schemas, 'keywords': keywords, 'nodes': nodes}, f, indent=4)
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write("Schemas by total time (ms):\n")
+        f.write(f"{'total':>10} {'select':>10} {'calls':>8} {'body':>10} {'calls':>8}  $id\n")
+        for sch in schemas[:profile_max_entries]:
+            f.write(f"{sch['time'] * 1000:10.2f} {sch['select_time'] * 1000:10.2f} {sch['select_calls']:8} "
+                    f"{sch['body_time'] * 1000:10.2f} {sch['body_calls']:8}  {sch['$id']}\n")
+            top_keywords = list(sch['keywords'].items())[:3]
+            if top_keywords:
+                f.write(' ' * 51 + ', '.join(f"{k}: {v['time'] * 1000:.2f}" for k, v in top_keywords) + '\n')
+
+        f.write("\nTop-level keywords by time (ms):\n")
+        for k, v in keywords.items():
+            f.write(f"{v['time'] * 1000:10.2f} {v['calls']:8}  {k}\n")
+
+        f.write("\nNodes by time (ms):\n")
+        for node in nodes:
+            f.write(f"{node['time'] * 1000:10.2f}  {node['file']}: {node['node']}\n")
+
+
+def _check_dtb_worker(job):
+    idx, filename = job
+
+    # The results used are only needed by the parent to save the cache
+    sg.node_cache_used = {} if node_cache_file else None
+    sg.node_cache_hits = 0
+    sg.node_cache_misses = 0
+    sg.error_count = 0
+    sg.error_ends = [] if max_errors else None
+
+    if sg.profile_nodes is not None:
+        sg.validator.profile = {}
+        sg.profile_nodes = []
+
+    output = io.StringIO()
+    with contextlib.redirect_stderr(output):
+        try:
+            sg.check_dtb(filename)
+        except max_errors_reached:
+            pass
+
+    return idx, output.getvalue(), (sg.node_cache_used, sg.node_cache_hits, sg.node_cache_misses), \
+           (sg.validator.profile, sg.profile_nodes), (sg.error_count, sg.error_ends)
+
+
+def check_dtbs_parallel(filenames, jobs):
+    """Check DTs in a pool of worker processes
+
+    The workers are forked after the schema is loaded so they all share the
+    parent's copy of it. Output is buffered per DT and printed in the same
+    order as the serial path, stopping at the error which reaches
+    'max_errors'.
+    """
+    # Start the largest DTBs first so the slowest file isn't left as the tail
+    order = sorted(range(len(filenames)), key=lambda i: os.path.getsize(filenames[i]), reverse=True)
+
+    results = {}
+    next_idx = 0
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for idx, output, cache, profile, errors in pool.imap_unordered(_check_dtb_worker, [(i, filenames[i]) for i in order]):
+            if profile[0]:
+                sg.validator.merge_profile(profile[0])
+                for entry in profile[1]:
+                    if len(sg.profile_nodes) < profile_max_entries:
+                        heapq.heappush(sg.profile_nodes, entry)
+                    else:
+                        heapq.heappushpop(sg.profile_nodes, entry)
+
+            # Keep the nodes checked by the workers for saving the cache
+            if cache[0]:
+                sg.node_cache.update(cache[0])
+                sg.node_cache_used.update(cache[0])
+            sg.node_cache_hits += cache[1]
+            sg.node_cache_misses += cache[2]
+
+            results[idx] = (output, errors)
+            while next_idx in results:
+                if verbose:
+                    print("Check:  " + filenames[next_idx])
+                    sys.stdout.flush()
+                output, errors = results.pop(next_idx)
+                count = errors[0]
+                if max_errors and sg.error_count + count >= max_errors:
+                    count = max_errors - sg.error_count
+                    output = output[:errors[1][count - 1]]
+                sg.error_count += count
+                sys.stderr.write(output)
+                sys.stderr.flush()
+                next_idx += 1
+
+                if max_errors and sg.error_count >= max_errors:
+                    # Leaving the pool stops the workers
+                    return
+
+
+class ValidationHandler(socketserver.StreamRequestHandler):
+    # Runs in a forked child, so a stalled client only holds up its own request
+    timeout = server_request_timeout
+
+    def handle(self):
+        global verbose
+        global show_unmatched
+        global match_schema_file
+        global compatible_match
+        global check_paths
+
+        try:
+            req = json.loads(self.rfile.readline())
+            schema_file = req.get('schema', "")
+            if schema_file != "" and not os.path.exists(schema_file):
+                raise FileNotFoundError(f"schema not found: {schema_file}")
+        except Exception as e:
+            self.wfile.write(f"{os.path.basename(sys.argv[0])}: server error: {e}\n".encode())
+            return
+
+        # The options don't leak between requests as this is a forked child
+        verbose = req.get('verbose', False)
+        show_unmatched = req.get('show_unmatched', False)
+        match_schema_file = req.get('limit')
+        compatible_match = req.get('compatible_match', False)
+        check_paths = req.get('paths')
+
+        key = self.server.get_schema_key(schema_file)
+        sg = self.server.schema_groups.get(key)
+        loaded = sg is None
+        if loaded:
+            sg = schema_group(schema_file)
+
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+        with contextlib.redirect_stderr(out):
+            try:
+                dtb = None
+                if 'size' in req:
+                    dtb = self.rfile.read(req['size'])
+                sg.check_dtb(req['dtb'], dtb)
+            except Exception:
+                traceback.print_exc()
+        out.detach()
+
+        if loaded:
+            # Let the client finish, then pass the schema on to the server
+            self.request.shutdown(socket.SHUT_WR)
+            self.server.save_schema_group(key, sg)
+
+
+class ValidationServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Server keeping schemas loaded to check DTBs for 'dt-validate --connect'
+
+    Each request is a JSON object on a single line with the schema, the DTB
+    filename and the validation options. If the request has a 'size', the
+    DTB data follows the request instead of being read from the file. The
+    response is the same output as dt-validate would print.
+
+    Requests are read and handled in a forked process, so a slow client or
+    schema doesn't hold up other requests. A process which had to load the
+    schema itself saves it as a snapshot afterwards, which the server loads
+    so that it stays loaded for later requests.
+    """
+    def __init__(self, path):
+        self.schema_groups = collections.OrderedDict()
+        self.snapshot_dir = tempfile.mkdtemp(prefix='dt-validate-')
+        super().__init__(path, ValidationHandler)
+
+    def get_schema_key(self, schema_file):
+        # Schemas are reloaded when a processed schema is rebuilt or a schema
+        # file in a directory changes
+        if os.path.isdir(schema_file):
+            filenames = sorted(glob.glob(os.path.join(schema_file, '**/*.yaml'), recursive=True))
+        else:
+            filenames = [schema_file]
+
+        key = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+                key += [[filename, st.st_mtime_ns, st.st_size]]
+            except OSError:
+                key += [[filename, None, None]]
+
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def add_schema_group(self, key, sg):
+        self.schema_groups[key] = sg
+        self.schema_groups.move_to_end(key)
+        if len(self.schema_groups) > server_max_schemas:
+            self.schema_groups.popitem(last=False)
+
+    def save_schema_group(self, key, sg):
+        with tempfile.NamedTemporaryFile(dir=self.snapshot_dir, suffix='.tmp', delete=False) as f:
+            sg.validator.save_snapshot(f)
+        os.replace(f.name, os.path.join(self.snapshot_dir, key + '.snapshot'))
+
+    def service_actions(self):
+        super().service_actions()
+
+        # Keep the schemas loaded by the request handlers
+        for name in os.listdir(self.snapshot_dir):
+            if not name.endswith('.snapshot'):
+                continue
+            filename = os.path.join(self.snapshot_dir, name)
+            try:
+                self.add_schema_group(name[:-len('.snapshot')], schema_group(filename))
+            except Exception as e:
+                print(f"{os.path.basename(sys.argv[0])}: server error: {e}", file=sys.stderr)
+            os.unlink(filename)
+
+    def server_close(self):
+        super().server_close()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+
+def serve(socket_path, schema_file=""):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # Exit normally when stopped so the snapshot directory is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with ValidationServer(socket_path) as server:
+        if schema_file:
+            schema_file = os.path.abspath(schema_file)
+            server.add_schema_group(server.get_schema_key(schema_file), schema_group(schema_file))
+        server.serve_forever()
+
+
+def check_dtb_remote(socket_path, schema_file, filename):
+    """Check a DT using a server started with 'dt-validate --serve'"""
+    req = {
+        'schema': os.path.abspath(schema_file) if schema_file else "",
+        'dtb': os.path.abspath(filename),
+        'verbose': verbose,
+        'show_unmatched': show_unmatched,
+        'limit': match_schema_file,
+        'compatible_match': compatible_match,
+        'paths': check_paths,
+    }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+        s.shutdown(socket.SHUT_WR)
+
+        sys.stderr.flush()
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            sys.stderr.buffer.write(data)
+        sys.stderr.flush()
 
 
 def main():
@@ -100,6 +632,11 @@ def main():
     global show_unmatched
     global match_schema_file
     global compatible_match
+    global check_paths
+    global node_cache_file
+    global count_only
+    global max_errors
+    global sg
 
     ap = argparse.ArgumentParser(fromfile_prefix_chars='@',
         epilog='Arguments can also be passed in a file prefixed with a "@" character.')
@@ -114,6 +651,27 @@ def main():
     ap.add_argument('-m', '--show-unmatched',
         help="Print out node 'compatible' strings which don't match any schema.",
         action="store_true")
+    ap.add_argument('--path', action='append',
+                    help="only decode and check the subtree at PATH, which can start with an alias. "
+                         "Can be given more than once.")
+    ap.add_argument('--base', metavar='DTB',
+                    help="check DTB, then check the dtbs as overlays (.dtbo) applied to it")
+    ap.add_argument('-j', '--jobs', type=int, default=1,
+                    help="number of DTBs to check in parallel (0 for one per CPU)")
+    ap.add_argument('--node-cache', metavar='FILE',
+                    help="file to keep the results of checking nodes in between runs")
+    ap.add_argument('--profile', metavar='FILE',
+                    help="write a report of the time spent checking with each schema and node to FILE "
+                         "and FILE.json. Results aren't cached when profiling.")
+    ap.add_argument('--max-errors', metavar='N', type=int,
+                    help="stop checking after N errors have been reported")
+    ap.add_argument('--count-only', action="store_true",
+                    help="print the number of errors instead of the errors")
+    ap.add_argument('--serve', metavar='SOCKET',
+                    help="run a server on the Unix socket SOCKET which keeps schemas loaded between checks")
+    ap.add_argument('--connect', metavar='SOCKET',
+                    help="check DTBs with a server started with '--serve'. DTBs are passed by path, so the "
+                         "server must share the filesystem.")
     ap.add_argument('-n', '--line-number', help="Obsolete", action="store_true")
     ap.add_argument('-v', '--verbose', help="verbose mode", action="store_true")
     ap.add_argument('-u', '--url-path', help="Additional search path for references (deprecated)")
@@ -126,6 +684,7 @@ def main():
     if args.limit:
         match_schema_file = args.limit.split(':')
     compatible_match = args.compatible_match
+    check_paths = args.path
 
     # Maintain prior behaviour which accepted file paths by stripping the file path
     if args.url_path and args.limit:
@@ -136,23 +695,84 @@ def main():
             match_schema_file[i] = match
 
     if args.preparse:
-        sg = schema_group(args.preparse)
+        schema_file = args.preparse
     elif args.schema:
-        sg = schema_group(args.schema)
+        schema_file = args.schema
     else:
-        sg = schema_group()
+        schema_file = ""
+
+    if args.serve:
+        serve(args.serve, schema_file)
+        return
+
+    if args.base and (args.path or args.connect):
+        ap.error("--base can't be used with --path or --connect")
+    if (args.max_errors is not None or args.count_only) and args.connect:
+        ap.error("--max-errors and --count-only can't be used with --connect")
+    if (args.jobs != 1 or args.profile or args.node_cache) and args.connect:
+        ap.error("--jobs, --profile and --node-cache can't be used with --connect")
+    if args.max_errors is not None and args.max_errors < 1:
+        ap.error("--max-errors must be at least 1")
 
+    if not args.connect:
+        sg = schema_group(schema_file)
+
+    dtb_files = []
     for d in args.dtbs:
         if not os.path.isdir(d):
             continue
-        for filename in glob.iglob(d + "/**/*.dtb", recursive=True):
-            if verbose:
-                print("Check:  " + filename)
-            sg.check_dtb(filename)
+        dtb_files += glob.glob(d + ("/**/*.dtbo" if args.base else "/**/*.dtb"), recursive=True)
 
     for filename in args.dtbs:
         if not os.path.isfile(filename):
             continue
-        if verbose:
-            print("Check:  " + filename)
-        sg.check_dtb(filename)
+        dtb_files += [filename]
+
+    if args.connect:
+        for filename in dtb_files:
+            if verbose:
+                print("Check:  " + filename)
+            check_dtb_remote(args.connect, schema_file, filename)
+        return
+
+    if args.profile:
+        sg.enable_profile()
+
+    node_cache_file = args.node_cache
+    if node_cache_file:
+        sg.load_node_cache(node_cache_file)
+
+    count_only = args.count_only
+    max_errors = args.max_errors
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    try:
+        if args.base:
+            if verbose:
+                print("Check:  " + args.base)
+            sg.check_overlays(args.base, dtb_files)
+        elif jobs > 1 and len(dtb_files) > 1:
+            check_dtbs_parallel(dtb_files, jobs)
+        else:
+            for filename in dtb_files:
+                if verbose:
+                    print("Check:  " + filename)
+                sg.check_dtb(filename)
+    except max_errors_reached:
+        pass
+
+    if verbose:
+        checked = sg.node_cache_hits + sg.node_cache_misses
+        print(f"Node cache: {sg.node_cache_hits} of {checked} nodes found "
+              f"({100 * sg.node_cache_hits / max(checked, 1):.1f}% hit rate)")
+
+    if node_cache_file:
+        sg.save_node_cache(node_cache_file)
+
+    if args.profile:
+        write_profile(args.profile)
+
+    if count_only:
+        print(sg.error_count)
+    if count_only or max_errors:
+        return 1 if sg.error_count else 0
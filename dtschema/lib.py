@@ -20,6 +20,65 @@ class sized_int(int):
         self.size = size
 
 
+class sized_array(list):
+    '''A list of integers which are all the same size
+
+    The values are stored as plain ints and are only wrapped in a sized_int
+    when accessed, so large arrays don't need a sized_int object per value.
+    '''
+    __slots__ = ('size',)
+
+    def __init__(self, values=(), size=32):
+        super().__init__(values)
+        self.size = size
+
+    def _sized_values(self, values):
+        size = self.size
+        for value in values:
+            # Skip calling sized_int's __new__ and __init__
+            value = int.__new__(sized_int, value)
+            value.size = size
+            yield value
+
+    def __iter__(self):
+        return self._sized_values(list.__iter__(self))
+
+    def __reversed__(self):
+        return self._sized_values(list.__reversed__(self))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return sized_array(list.__getitem__(self, index), size=self.size)
+        return sized_int(list.__getitem__(self, index), size=self.size)
+
+    def __reduce__(self):
+        return sized_array, (list.copy(self), self.size)
+
+    def copy(self):
+        return sized_array(list.copy(self), size=self.size)
+
+    def __add__(self, other):
+        # Only values of the same size stay a sized_array, otherwise each
+        # value keeps its size as a sized_int
+        if isinstance(other, sized_array) and other.size == self.size:
+            return sized_array(list.__add__(self, other), size=self.size)
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __iadd__(self, other):
+        if isinstance(other, sized_array) and other.size == self.size:
+            list.extend(self, list.__iter__(other))
+            return self
+        return NotImplemented
+
+    def __mul__(self, n):
+        return sized_array(list.__mul__(self, n), size=self.size)
+
+    __rmul__ = __mul__
+
+
 def _value_is_type(subschema, key, type):
     if key not in subschema:
         return False
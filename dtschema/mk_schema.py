@@ -6,6 +6,7 @@
 import sys
 import argparse
 import json
+import pickle
 
 import ruamel.yaml
 import dtschema
@@ -18,6 +19,17 @@ def main():
                     help="Filename of the processed schema")
     ap.add_argument("-j", "--json", help="Encode the processed schema in json",
                     action="store_true")
+    ap.add_argument("-b", "--binary", help="Encode the processed schema as a binary snapshot which is faster to load",
+                    action="store_true")
+    ap.add_argument("-r", "--resolve-refs",
+                    help="Link each $ref to the schema it refers to ahead of validation (needs -b)",
+                    action="store_true")
+    ap.add_argument("-O", "--optimize",
+                    help="Simplify the processed schema without changing validation results and report the reduction",
+                    action="store_true")
+    ap.add_argument("-c", "--compatible-index",
+                    help="Output a standalone index of the documented compatible strings for dt-check-compatible",
+                    action="store_true")
     ap.add_argument("schemas", nargs='*', type=str,
                     help="Names of directories, or YAML encoded schema files")
     ap.add_argument('-u', '--useronly', help="Only process user schemas", action="store_true")
@@ -25,10 +37,41 @@ def main():
                     action="version", version=dtschema.__version__)
     args = ap.parse_args()
 
-    schemas = dtschema.DTValidator(args.schemas).schemas
+    if args.resolve_refs and not args.binary:
+        ap.error("--resolve-refs needs --binary as only a snapshot can keep the links")
+
+    dtval = dtschema.DTValidator(args.schemas)
+    schemas = dtval.schemas
     if not schemas:
         return -1
 
+    if args.compatible_index:
+        if args.outfile:
+            f = open(args.outfile, 'w', encoding='utf-8')
+        else:
+            f = sys.stdout
+        dtval.get_compatible_matcher().save(f)
+        return
+
+    if args.optimize:
+        json_size = len(json.dumps(schemas))
+        snapshot_size = len(pickle.dumps(schemas))
+        stats = dtval.optimize_schemas()
+        for k, v in stats.items():
+            print(f"{k}: {v}", file=sys.stderr)
+        print(f"json size: {json_size} -> {len(json.dumps(schemas))} bytes", file=sys.stderr)
+        print(f"snapshot size: {snapshot_size} -> {len(pickle.dumps(schemas))} bytes", file=sys.stderr)
+
+    if args.binary:
+        if args.outfile:
+            f = open(args.outfile, 'wb')
+        else:
+            f = sys.stdout.buffer
+        if args.resolve_refs:
+            dtval.resolve_refs()
+        dtval.save_snapshot(f)
+        return
+
     if args.outfile:
         f = open(args.outfile, 'w', encoding='utf-8')
     else:
@@ -8,6 +8,14 @@ import re
 import copy
 import glob
 import json
+import time
+import pickle
+import hashlib
+import tempfile
+import io
+import contextlib
+import multiprocessing
+import urllib.parse
 import jsonschema
 
 from jsonschema.exceptions import RefResolutionError
@@ -19,6 +27,27 @@ from dtschema.schema import DTSchema
 
 schema_basedir = os.path.dirname(os.path.abspath(__file__))
 
+# If DTSCHEMA_CACHE_DIR is set, processed schema files are cached there by
+# content so unchanged files aren't processed again
+schema_cache_dir = os.environ.get('DTSCHEMA_CACHE_DIR', '')
+
+# Hash of the dtschema code and meta-schemas, set on first use of the cache
+schema_code_hash = None
+
+# Minimum number of schema files needing processing to use a process pool
+parallel_schema_threshold = 32
+
+# Processed schema snapshots start with this followed by a format number
+snapshot_magic = b'\x89dtschema-snapshot\n'
+snapshot_format = 1
+
+# DTValidator state saved in a snapshot
+snapshot_attrs = ['schemas', 'props', 'pat_props', 'compat_map', 'always_schemas',
+                  'select_always', 'select_index']
+
+# Compatible indexes written by compatible_matcher.save() start with this
+compatible_index_magic = b'{"dtschema-compatible-index":'
+
 
 def _merge_dim(dim1, dim2):
     d = []
@@ -263,13 +292,105 @@ def make_compatible_schema(schemas):
         'properties': {
             'compatible': {
                 'items': {
-                    'anyOf': compat_sch
+                    'documentedCompatible': compat_sch
                 }
             }
         }
     }
 
 
+class compatible_matcher():
+    '''Check compatible strings against the documented compatibles
+
+    This gives the same result as checking against the
+    'generated-compatibles' schema, but looks up fixed strings in a set and
+    searches for all the patterns with a single regex.
+    '''
+    def __init__(self, compatibles, patterns):
+        self.compatibles = frozenset(compatibles)
+        self.patterns = list(patterns)
+        self.regex = None
+        self.regexes = []
+        combined = []
+        for pattern in self.patterns:
+            if re.search(r'\\[1-9]|\(\?P=', pattern):
+                # Back references can't be combined with other patterns
+                self.regexes += [re.compile(pattern)]
+            else:
+                combined += [pattern]
+
+        if combined:
+            try:
+                self.regex = re.compile('|'.join(f'(?:{p})' for p in combined))
+            except re.error:
+                self.regexes += [re.compile(p) for p in combined]
+
+    @classmethod
+    def from_schema(cls, schema):
+        '''Create a matcher from the 'enum' and 'pattern' schemas of a
+        'documentedCompatible' keyword'''
+        compatibles = []
+        patterns = []
+        for sch in schema:
+            if 'enum' in sch:
+                compatibles += sch['enum']
+            else:
+                patterns += [sch['pattern']]
+        return cls(compatibles, patterns)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a compatible index written by save()'''
+        with open(filename, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+        if index.get('dtschema-compatible-index') != dtschema.__version__:
+            raise Exception(f"Compatible index out of date, delete and retry: {os.path.abspath(filename)}")
+
+        return cls(index['compatibles'], index['patterns'])
+
+    def save(self, f):
+        '''Save the compatibles and patterns as a standalone JSON index'''
+        json.dump({'dtschema-compatible-index': dtschema.__version__,
+                   'compatibles': sorted(self.compatibles),
+                   'patterns': self.patterns}, f)
+
+    def is_documented(self, compatible):
+        if compatible in self.compatibles:
+            return True
+        if self.regex and self.regex.search(compatible):
+            return True
+        return any(regex.search(compatible) for regex in self.regexes)
+
+    def get_undocumented(self, compatible_list):
+        return [c for c in compatible_list if not self.is_documented(c)]
+
+
+def is_compatible_index(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(compatible_index_magic)) == compatible_index_magic
+    except OSError:
+        return False
+
+
+# Keywords with a subschema, a list of subschemas or a map of subschemas
+_subschema_keywords = {'additionalProperties', 'unevaluatedProperties', 'additionalItems', 'unevaluatedItems',
+                       'items', 'contains', 'propertyNames', 'not', 'if', 'then', 'else', 'select'}
+_subschema_list_keywords = {'allOf', 'anyOf', 'oneOf', 'items', 'prefixItems'}
+_subschema_map_keywords = {'properties', 'patternProperties', 'dependentSchemas', 'definitions', '$defs'}
+
+
+def _iter_subschemas(schema):
+    for k, v in schema.items():
+        if k in _subschema_map_keywords and isinstance(v, dict):
+            yield from v.values()
+        elif k in _subschema_list_keywords and isinstance(v, list):
+            yield from v
+        elif k in _subschema_keywords:
+            yield v
+
+
 def process_schema(filename):
     try:
         dtsch = DTSchema(filename)
@@ -293,8 +414,120 @@ def process_schema(filename):
     return schema
 
 
-def _add_schema(schemas, filename):
-    sch = process_schema(os.path.abspath(filename))
+def _get_schema_code_hash():
+    '''Hash the files which affect how schemas are processed
+
+    The version doesn't change between commits of a git checkout, so the
+    code and meta-schemas themselves are hashed.
+    '''
+    global schema_code_hash
+
+    if schema_code_hash is None:
+        h = hashlib.sha256(dtschema.__version__.encode())
+        files = glob.glob(os.path.join(schema_basedir, '*.py')) + \
+                glob.glob(os.path.join(schema_basedir, 'meta-schemas/**/*.yaml'), recursive=True)
+        for filename in sorted(files):
+            h.update(b'\0' + os.path.relpath(filename, schema_basedir).encode() + b'\0')
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        schema_code_hash = h.hexdigest()
+
+    return schema_code_hash
+
+
+def _get_schema_cache_file(filename):
+    '''Get the cache file for a schema file'''
+    if not schema_cache_dir:
+        return None
+
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    key = hashlib.sha256(_get_schema_code_hash().encode() + b'\0' + data).hexdigest()
+    return os.path.join(schema_cache_dir, key[:2], key + '.pickle')
+
+
+def load_cached_schema(filename):
+    '''Get the processed schema for a file from a prior run if unchanged
+
+    Results are keyed by a hash of the file contents and the dtschema code.
+    '''
+    cache_file = _get_schema_cache_file(filename)
+    if not cache_file:
+        return None
+
+    try:
+        with open(cache_file, 'rb') as f:
+            schema = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    schema['$filename'] = filename
+    return schema
+
+
+def save_cached_schema(filename, schema):
+    cache_file = _get_schema_cache_file(filename)
+    if not cache_file:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_file), delete=False) as f:
+            pickle.dump(schema, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cache_file)
+    except OSError:
+        pass
+
+
+def _process_schema_worker(filename):
+    output = io.StringIO()
+    with contextlib.redirect_stderr(output):
+        schema = process_schema(filename)
+
+    return schema, output.getvalue()
+
+
+def process_schema_files(filenames):
+    '''Process schema files, using a process pool if many need processing
+
+    Yields the processed schemas in the same order as filenames. Messages
+    from processing a file are printed just before it is yielded so they are
+    in the same order as processing the files serially.
+    '''
+    results = [None] * len(filenames)
+    misses = []
+    for i, filename in enumerate(filenames):
+        schema = load_cached_schema(filename)
+        if schema:
+            results[i] = (schema, '')
+        else:
+            misses += [i]
+
+    # Schemas with errors aren't cached so the errors are reported every time
+    if len(misses) >= parallel_schema_threshold and (os.cpu_count() or 1) > 1 and \
+       not multiprocessing.current_process().daemon:
+        with multiprocessing.get_context('fork').Pool() as pool:
+            for i, result in zip(misses, pool.imap(_process_schema_worker,
+                                                   [filenames[i] for i in misses], chunksize=8)):
+                results[i] = result
+    else:
+        for i in misses:
+            results[i] = _process_schema_worker(filenames[i])
+
+    for i in misses:
+        if results[i][0]:
+            save_cached_schema(filenames[i], results[i][0])
+
+    for schema, output in results:
+        sys.stderr.write(output)
+        yield schema
+
+
+def _add_schema(schemas, sch):
     if not sch or '$id' not in sch:
         return False
     if sch['$id'] in schemas:
@@ -309,21 +542,29 @@ def _add_schema(schemas, filename):
 def process_schemas(schema_paths, core_schema=True):
     schemas = {}
 
-    for filename in schema_paths:
-        if not os.path.isfile(filename):
-            continue
-        _add_schema(schemas, filename)
+    filenames = [os.path.abspath(f) for f in schema_paths if os.path.isfile(f)]
+    user_files = len(filenames)
 
     if core_schema:
         schema_paths.append(os.path.join(schema_basedir, 'schemas/'))
 
+    path_files = []
     for path in schema_paths:
-        count = 0
         if not os.path.isdir(path):
             continue
+        files = list(glob.iglob(os.path.join(os.path.abspath(path), "**/*.yaml"), recursive=True))
+        path_files += [(path, len(files))]
+        filenames += files
+
+    processed = process_schema_files(filenames)
+
+    for i in range(user_files):
+        _add_schema(schemas, next(processed))
 
-        for filename in glob.iglob(os.path.join(os.path.abspath(path), "**/*.yaml"), recursive=True):
-            if _add_schema(schemas, filename):
+    for path, nr_files in path_files:
+        count = 0
+        for i in range(nr_files):
+            if _add_schema(schemas, next(processed)):
                 count += 1
 
         if count == 0:
@@ -332,16 +573,161 @@ def process_schemas(schema_paths, core_schema=True):
     return schemas
 
 
+def _has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    escaped = False
+    for c in pattern:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+
+    return False
+
+
+def _get_pattern_prefix(pattern):
+    '''Get the fixed string a 'pattern' requires at the start of a match'''
+    # Alternation at the top level means there is no single prefix
+    if not pattern.startswith('^') or _has_top_level_alternation(pattern):
+        return ''
+
+    prefix = ''
+    for c in pattern[1:]:
+        if not (c.isalnum() or c in ',-_@/'):
+            # The last char is optional or repeated
+            if c in '?*{':
+                prefix = prefix[:-1]
+            break
+        prefix += c
+
+    return prefix
+
+
+def _get_pattern_suffix(pattern):
+    '''Get the fixed string a 'pattern' requires at the end of a match'''
+    if not pattern.endswith('$') or _has_top_level_alternation(pattern):
+        return ''
+
+    # '$' is escaped if preceded by an odd number of '\\'
+    end = len(pattern) - 1
+    if (end - len(pattern[:end].rstrip('\\'))) % 2:
+        return ''
+
+    start = end
+    while start > 0 and (pattern[start - 1].isalnum() or pattern[start - 1] in ',-_@/'):
+        start -= 1
+
+    # The first char is part of an escape sequence such as '\d'
+    if start > 0 and pattern[start - 1] == '\\':
+        start += 1
+
+    return pattern[start:end]
+
+
+def _get_select_values(subschema):
+    '''Get the strings and string prefixes a string schema can match'''
+    if not isinstance(subschema, dict):
+        return None
+
+    if isinstance(subschema.get('const'), str):
+        return {subschema['const']}, set()
+    if 'enum' in subschema and all(isinstance(v, str) for v in subschema['enum']):
+        return set(subschema['enum']), set()
+    if isinstance(subschema.get('pattern'), str):
+        prefix = _get_pattern_prefix(subschema['pattern'])
+        if prefix:
+            return set(), {prefix}
+
+    return None
+
+
+def _get_select_key(select):
+    '''Get a property and the values a node must have for 'select' to match
+
+    Only conditions which are necessary for 'select' to match are returned.
+    The 'select' schema must still be tested on nodes that pass them. Returns
+    None if 'select' can't be reduced to a condition on a required property.
+    '''
+    if not isinstance(select, dict) or not select.get('required'):
+        return None
+
+    props = select.get('properties', {})
+    for prop in select['required']:
+        subschema = props.get(prop)
+        if not isinstance(subschema, dict):
+            continue
+        if 'contains' in subschema:
+            values = _get_select_values(subschema['contains'])
+        elif isinstance(subschema.get('items'), list) and subschema.get('minItems', 0) > 0:
+            values = _get_select_values(subschema['items'][0])
+        else:
+            values = None
+
+        if values:
+            return prop, values
+
+    return select['required'][0], None
+
+
+class schema_ref(str):
+    '''A '$ref' value linked to the schema it refers to
+
+    Anything other than validation, such as printing errors or saving a
+    processed schema, just sees the original reference string.
+    '''
+    def __new__(cls, ref, schema):
+        self = str.__new__(cls, ref)
+        self.schema = schema
+        return self
+
+    def __getnewargs__(self):
+        return str(self), None
+
+
+def ref(validator, ref, instance, schema):
+    # References linked by DTValidator.resolve_refs() don't need the resolver
+    if isinstance(ref, schema_ref):
+        yield from validator.descend(instance, ref.schema)
+    else:
+        yield from jsonschema.Draft201909Validator.VALIDATORS['$ref'](validator, ref, instance, schema)
+
+
+def documentedCompatible(validator, compatibles, instance, schema):
+    # The same as 'anyOf'. DTValidator checks strings with a
+    # compatible_matcher first.
+    yield from validator.VALIDATORS['anyOf'](validator, compatibles, instance, schema)
+
+
 def typeSize(validator, typeSize, instance, schema):
-    try:
+    # Arrays of sized values don't have a size themselves
+    if isinstance(instance, dtschema.sized_int):
         size = instance.size
-    except:
+    else:
         size = 32
 
     if typeSize != size:
         yield jsonschema.ValidationError("size is %r, expected %r" % (size, typeSize))
 
 
+def is_snapshot(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(snapshot_magic)) == snapshot_magic
+    except OSError:
+        return False
+
+
 class DTValidator:
     '''Custom Validator for Devicetree Schemas
 
@@ -350,13 +736,28 @@ class DTValidator:
     files can be validated with the .check_schema() method, and .validate()
     will check the data in a devicetree file.
     '''
-    DtValidator = jsonschema.validators.extend(jsonschema.Draft201909Validator, {'typeSize': typeSize})
+    DtValidator = jsonschema.validators.extend(jsonschema.Draft201909Validator,
+                                               {'$ref': ref, 'typeSize': typeSize,
+                                                'documentedCompatible': documentedCompatible})
 
     def __init__(self, schema_files, filter=None):
         self.schemas = {}
         self.resolver = jsonschema.RefResolver('', None, handlers={'http': self.http_handler})
+        self.profile = None
         schema_cache = None
 
+        # compatible_matcher for each 'documentedCompatible' keyword value by
+        # id, along with the value so the id isn't reused
+        self.compatible_matchers = {}
+        self.DtValidator = jsonschema.validators.extend(self.DtValidator,
+                                                        {'documentedCompatible': self._documented_compatible})
+
+        if len(schema_files) == 1 and is_snapshot(schema_files[0]):
+            self.load_snapshot(schema_files[0])
+            self.make_pattern_index()
+            self.make_validators()
+            return
+
         if len(schema_files) == 1 and os.path.isfile(schema_files[0]):
             # a processed schema file
             with open(schema_files[0], 'r', encoding='utf-8') as f:
@@ -412,8 +813,377 @@ class DTValidator:
                               f'\t{self.compat_map[c]}\n\t{sch["$id"]}', file=sys.stderr)
                     self.compat_map[c] = sch['$id']
 
+        self.make_pattern_index()
+        self.make_select_index()
+        self.make_validators()
+
         self.schemas['version'] = dtschema.__version__
 
+    def load_snapshot(self, filename):
+        '''Load a processed schema snapshot written by save_snapshot()'''
+        with open(filename, 'rb') as f:
+            header = f.readline() + f.readline()
+            if header != snapshot_magic + b'%d\n' % snapshot_format:
+                raise Exception(f"Processed schema snapshot format not supported, delete and retry: {os.path.abspath(filename)}")
+            snapshot = pickle.load(f)
+
+        if snapshot.get('version') != dtschema.__version__:
+            raise Exception(f"Processed schema out of date, delete and retry: {os.path.abspath(filename)}")
+
+        for attr in snapshot_attrs:
+            setattr(self, attr, snapshot[attr])
+
+    def save_snapshot(self, f):
+        '''Save the processed schemas and lookup tables to a binary file
+
+        The snapshot is a pickle, so only load snapshots from trusted sources.
+        '''
+        snapshot = {attr: getattr(self, attr) for attr in snapshot_attrs}
+        snapshot['version'] = dtschema.__version__
+
+        f.write(snapshot_magic + b'%d\n' % snapshot_format)
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def resolve_refs(self):
+        '''Link each '$ref' in the schemas to the schema it refers to
+
+        The references are replaced with schema_ref strings, so validating
+        follows them without the resolver. A reference to a schema which is
+        only another reference links to the end of the chain. References
+        which can't be resolved are left for the resolver to report.
+        '''
+        refs = []
+
+        def resolve(sch):
+            if isinstance(sch, dict):
+                scope = sch.get('$id')
+                if isinstance(scope, str):
+                    self.resolver.push_scope(scope)
+                for k, v in sch.items():
+                    if k == '$ref' and isinstance(v, str) and not isinstance(v, schema_ref):
+                        try:
+                            refs.append(schema_ref(v, self.resolver.resolve(v)[1]))
+                        except RefResolutionError:
+                            continue
+                        sch[k] = refs[-1]
+                    else:
+                        resolve(v)
+                if isinstance(scope, str):
+                    self.resolver.pop_scope()
+            elif isinstance(sch, list):
+                for v in sch:
+                    resolve(v)
+
+        for schema_id, sch in self.schemas.items():
+            # 'version' isn't a schema
+            if isinstance(sch, dict):
+                resolve(sch)
+
+        for r in refs:
+            seen = {id(r.schema)}
+            while isinstance(r.schema, dict) and r.schema.keys() == {'$ref'} and \
+                  isinstance(r.schema['$ref'], schema_ref) and id(r.schema['$ref'].schema) not in seen:
+                r.schema = r.schema['$ref'].schema
+                seen.add(id(r.schema))
+
+    def _walk_schemas(self, func):
+        # Call func on each subschema in the schemas with the resolver in
+        # the subschema's scope
+        def walk(sch):
+            if not isinstance(sch, dict):
+                return
+            scope = sch.get('$id')
+            if isinstance(scope, str):
+                self.resolver.push_scope(scope)
+            for v in _iter_subschemas(sch):
+                walk(v)
+            func(sch)
+            if isinstance(scope, str):
+                self.resolver.pop_scope()
+
+        for schema_id, sch in self.schemas.items():
+            # The generated tables aren't schemas to optimize
+            if isinstance(sch, dict) and not schema_id.startswith('generated-'):
+                walk(sch)
+
+    def _get_fixed_schemas(self):
+        # Get the ids of the subschemas which can't be changed. These are the
+        # ones an 'unevaluatedProperties' or 'unevaluatedItems' keyword looks
+        # into, as it depends on their 'properties' and on whether each
+        # 'allOf' entry as a whole is valid. Also the ones on the path of a
+        # '$ref' JSON pointer, which could refer to an entry removed.
+        fixed = set()
+
+        def mark(sch):
+            if not isinstance(sch, dict) or id(sch) in fixed:
+                return
+            fixed.add(id(sch))
+            scope = sch.get('$id')
+            if isinstance(scope, str):
+                self.resolver.push_scope(scope)
+
+            if isinstance(sch.get('$ref'), str):
+                try:
+                    url, target = self.resolver.resolve(sch['$ref'])
+                    self.resolver.push_scope(url)
+                    mark(target)
+                    self.resolver.pop_scope()
+                except RefResolutionError:
+                    pass
+            for k in ['allOf', 'anyOf', 'oneOf']:
+                for v in sch.get(k, []):
+                    mark(v)
+            for k in ['if', 'then', 'else']:
+                mark(sch.get(k))
+            for v in sch.get('dependentSchemas', {}).values():
+                mark(v)
+
+            if isinstance(scope, str):
+                self.resolver.pop_scope()
+
+        def mark_fixed(sch):
+            if {'unevaluatedProperties', 'unevaluatedItems'} & sch.keys():
+                mark(sch)
+
+            if not isinstance(sch.get('$ref'), str):
+                return
+            url, fragment = urllib.parse.urldefrag(urllib.parse.urljoin(self.resolver.resolution_scope, sch['$ref']))
+            try:
+                node = self.resolver.resolve(url)[1]
+            except RefResolutionError:
+                return
+            for part in urllib.parse.unquote(fragment).split('/')[1:]:
+                fixed.add(id(node))
+                part = part.replace('~1', '/').replace('~0', '~')
+                if isinstance(node, list) and part.isdigit() and int(part) < len(node):
+                    node = node[int(part)]
+                elif isinstance(node, dict) and part in node:
+                    node = node[part]
+                else:
+                    break
+
+        self._walk_schemas(mark_fixed)
+        return fixed
+
+    def optimize_schemas(self):
+        '''Simplify the schemas without changing the errors they report
+
+        Nested 'allOf' lists are flattened and always true 'allOf' entries
+        and 'properties' are removed, except where 'additionalProperties' or
+        'unevaluatedProperties' depends on them. Identical '$ref' only
+        schemas with an absolute reference are shared. Returns the number of
+        each change made.
+        '''
+        stats = {'allOf flattened': 0, 'true allOf entries': 0, 'true properties': 0, 'shared $refs': 0}
+        fixed = self._get_fixed_schemas()
+        refs = {}
+
+        def optimize(sch):
+            if id(sch) not in fixed and isinstance(sch.get('allOf'), list):
+                entries = []
+                for v in sch['allOf']:
+                    if v is True or v == {}:
+                        stats['true allOf entries'] += 1
+                    elif isinstance(v, dict) and v.keys() == {'allOf'} and isinstance(v['allOf'], list):
+                        stats['allOf flattened'] += 1
+                        entries += v['allOf']
+                    else:
+                        entries += [v]
+                if entries:
+                    sch['allOf'] = entries
+                else:
+                    del sch['allOf']
+
+            if id(sch) not in fixed and isinstance(sch.get('properties'), dict) and \
+               not {'additionalProperties', 'unevaluatedProperties'} & sch.keys():
+                props = {k: v for k, v in sch['properties'].items() if v is not True}
+                stats['true properties'] += len(sch['properties']) - len(props)
+                if props:
+                    sch['properties'] = props
+                else:
+                    del sch['properties']
+
+            for k in _subschema_map_keywords & sch.keys():
+                if not isinstance(sch[k], dict):
+                    continue
+                for prop, v in sch[k].items():
+                    sch[k][prop] = share_ref(v)
+            for k in _subschema_list_keywords & sch.keys():
+                if isinstance(sch[k], list):
+                    sch[k] = [share_ref(v) for v in sch[k]]
+            for k in _subschema_keywords & sch.keys():
+                sch[k] = share_ref(sch[k])
+
+        def share_ref(sch):
+            # Relative references depend on the scope, so can't be shared
+            if isinstance(sch, dict) and sch.keys() == {'$ref'} and isinstance(sch['$ref'], str) and \
+               sch['$ref'].startswith(('/', 'http:', 'https:')):
+                shared = refs.setdefault(sch['$ref'], sch)
+                if shared is not sch:
+                    stats['shared $refs'] += 1
+                return shared
+            return sch
+
+        self._walk_schemas(optimize)
+        return stats
+
+    def make_validators(self):
+        self.validators = {}
+        for schema_id in self.always_schemas:
+            sch = self.schemas[schema_id]
+            # Wrap once here rather than for every node checked
+            self.validators[schema_id] = self.DtValidator({'if': sch['select'], 'then': sch},
+                                                          resolver=self.resolver)
+
+    def make_pattern_index(self):
+        '''Index the pattern property types by the fixed string each pattern
+        requires at the start or end of a property name
+
+        Patterns which can't be indexed are combined into a single regex to
+        quickly rule them out. Property names only have to be searched with
+        the patterns which may match them.
+        '''
+        self.prop_type_cache = {}
+        # How to decode properties by name and length, see dtb.prop_value()
+        self.prop_decode_cache = {}
+        self.pat_entries = []
+        self.pat_prefixes = {}
+        self.pat_suffixes = {}
+        unindexed = []
+        self.pat_unindexed_always = []
+        for pattern, v in self.pat_props.items():
+            # Patterns without a type never affect the type lookups
+            if not v[0]['type']:
+                continue
+
+            i = len(self.pat_entries)
+            self.pat_entries += [v[0]]
+
+            prefix = _get_pattern_prefix(pattern)
+            suffix = _get_pattern_suffix(pattern)
+            if prefix and len(prefix) >= len(suffix):
+                self.pat_prefixes.setdefault(prefix, []).append(i)
+            elif suffix:
+                self.pat_suffixes.setdefault(suffix, []).append(i)
+            elif re.search(r'\\[1-9]|\(\?P=', pattern):
+                # Back references can't be combined with other patterns
+                self.pat_unindexed_always += [i]
+            else:
+                unindexed += [i]
+
+        self.pat_prefix_lens = sorted({len(p) for p in self.pat_prefixes})
+        self.pat_suffix_lens = sorted({len(p) for p in self.pat_suffixes})
+
+        self.pat_unindexed = unindexed
+        self.pat_unindexed_re = None
+        if unindexed:
+            try:
+                self.pat_unindexed_re = re.compile('|'.join(f"(?:{self.pat_entries[i]['regex'].pattern})"
+                                                            for i in unindexed))
+            except re.error:
+                self.pat_unindexed_always += unindexed
+                self.pat_unindexed = []
+
+    def get_pattern_types(self, propname):
+        '''Get the pattern property types matching propname in pat_props order'''
+        # '$' also matches before a trailing newline, so don't rely on suffixes
+        if '\n' in propname:
+            return [v for v in self.pat_entries if v['regex'].search(propname)]
+
+        candidates = set(self.pat_unindexed_always)
+        for l in self.pat_prefix_lens:
+            candidates.update(self.pat_prefixes.get(propname[:l], ()))
+        for l in self.pat_suffix_lens:
+            candidates.update(self.pat_suffixes.get(propname[-l:], ()))
+        if self.pat_unindexed_re and self.pat_unindexed_re.search(propname):
+            candidates.update(self.pat_unindexed)
+
+        return [self.pat_entries[i] for i in sorted(candidates)
+                if self.pat_entries[i]['regex'].search(propname)]
+
+    def _lookup_property_type(self, propname):
+        '''Get the types and dimensions of a property, memoized per name'''
+        try:
+            return self.prop_type_cache[propname]
+        except KeyError:
+            pass
+
+        ptype = set()
+        dim = None
+        has_dim = False
+        if propname in self.props:
+            for v in self.props[propname]:
+                if v['type']:
+                    ptype.add(v['type'])
+                if not has_dim and 'dim' in v:
+                    dim = v['dim']
+                    has_dim = True
+
+        if not ptype or not has_dim:
+            pat_types = self.get_pattern_types(propname)
+            if not ptype:
+                ptype = {v['type'] for v in pat_types}
+            if not has_dim:
+                dim = next((v['dim'] for v in pat_types if 'dim' in v), None)
+
+        # Don't return 'node' as a type if there's other types
+        if len(ptype) > 1 and 'node' in ptype:
+            ptype -= {'node'}
+
+        self.prop_type_cache[propname] = (frozenset(ptype), dim)
+        return self.prop_type_cache[propname]
+
+    def make_select_index(self):
+        '''Index the always applied schemas by what their 'select' requires
+
+        Schemas are indexed by a required property, and by the exact values or
+        value prefixes it must have when 'select' constrains them. Schemas
+        with a 'select' which can't be indexed are always tested.
+        '''
+        self.select_always = []
+        self.select_index = {}
+        for i, schema_id in enumerate(self.always_schemas):
+            key = _get_select_key(self.schemas[schema_id]['select'])
+            if not key:
+                self.select_always += [i]
+                continue
+
+            prop, values = key
+            index = self.select_index.setdefault(prop, {'any': [], 'present': [], 'values': {}, 'prefixes': {}})
+            index['any'] += [i]
+            if not values:
+                index['present'] += [i]
+                continue
+
+            for v in values[0]:
+                index['values'].setdefault(v, []).append(i)
+            for v in values[1]:
+                index['prefixes'].setdefault(v, []).append(i)
+
+        for index in self.select_index.values():
+            index['prefix_lens'] = sorted({len(v) for v in index['prefixes']})
+
+    def get_select_schemas(self, instance):
+        '''Get the always applied schemas which may match the instance'''
+        candidates = set(self.select_always)
+        for prop in instance.keys() & self.select_index.keys():
+            index = self.select_index[prop]
+            values = instance[prop]
+            # Values which aren't a list of strings can't be looked up, so get
+            # all the schemas requiring the property
+            if not isinstance(values, list) or not values or \
+               not all(isinstance(v, str) for v in values):
+                candidates.update(index['any'])
+                continue
+
+            candidates.update(index['present'])
+            for v in values:
+                candidates.update(index['values'].get(v, ()))
+                for l in index['prefix_lens']:
+                    candidates.update(index['prefixes'].get(v[:l], ()))
+
+        return [self.always_schemas[i] for i in sorted(candidates)]
+
     def http_handler(self, uri):
         '''Custom handler for http://devicetree.org references'''
         try:
@@ -440,31 +1210,134 @@ class DTValidator:
                 return True
         return False
 
-    def iter_errors(self, instance, filter=None, compatible_match=False):
+    def get_validator(self, schema_id):
+        '''Get the validator for a schema, creating it on first use'''
+        try:
+            return self.validators[schema_id]
+        except KeyError:
+            validator = self.DtValidator(self.schemas[schema_id], resolver=self.resolver)
+            self.validators[schema_id] = validator
+            return validator
+
+    def get_schema_ids(self, instance, filter=None, compatible_match=False):
+        '''Get the $id of each schema iter_errors() checks the instance with'''
+        schema_ids = []
         if 'compatible' in instance:
             for inst_compat in instance['compatible']:
                 if inst_compat in self.compat_map:
                     schema_id = self.compat_map[inst_compat]
                     if self._filter_match(schema_id, filter):
-                        schema = self.schemas[schema_id]
-                        for error in self.DtValidator(schema,
-                                                    resolver=self.resolver,
-                                                    ).iter_errors(instance):
-                            self.annotate_error(schema['$id'], error)
-                            yield error
+                        schema_ids += [schema_id]
                     break
 
         if compatible_match:
+            return schema_ids
+
+        for schema_id in self.get_select_schemas(instance):
+            if self._filter_match(schema_id, filter):
+                schema_ids += [schema_id]
+
+        return schema_ids
+
+    def iter_errors(self, instance, filter=None, compatible_match=False):
+        if self.profile is not None:
+            yield from self._iter_errors_profile(instance, filter, compatible_match)
             return
 
-        for schema_id in self.always_schemas:
-            if not self._filter_match(schema_id, filter):
-                continue
-            schema = {'if': self.schemas[schema_id]['select'],
-                      'then': self.schemas[schema_id]}
-            for error in self.DtValidator(schema,
-                                          resolver=self.resolver,
-                                          ).iter_errors(instance):
+        for schema_id in self.get_schema_ids(instance, filter, compatible_match):
+            for error in self.get_validator(schema_id).iter_errors(instance):
+                self.annotate_error(schema_id, error)
+                yield error
+
+    def enable_profile(self):
+        '''Record the time spent checking nodes with each schema
+
+        The time for each schema is split into evaluating 'select' and the
+        schema itself, and the latter is broken down by top-level keyword.
+        Time spent in a schema referenced by another schema is only charged
+        to the referenced schema, so the times add up to the total time.
+        '''
+        self.profile = {}
+        self.profile_stack = []
+
+        schemas = {id(sch): sch_id for sch_id, sch in self.schemas.items() if isinstance(sch, dict)}
+
+        def profile_keyword(keyword, func):
+            def wrapper(validator, value, instance, schema):
+                if id(schema) not in schemas:
+                    return func(validator, value, instance, schema)
+
+                errors, elapsed = self._profile_call(lambda: list(func(validator, value, instance, schema) or ()))
+                stats = self._get_profile_stats(schemas[id(schema)])
+                stats['body'][0] += elapsed
+                kw_stats = stats['keywords'].setdefault(keyword, [0.0, 0])
+                kw_stats[0] += elapsed
+                kw_stats[1] += 1
+                return errors
+
+            return wrapper
+
+        self.DtValidator = jsonschema.validators.extend(
+            self.DtValidator, {k: profile_keyword(k, f) for k, f in self.DtValidator.VALIDATORS.items()})
+        self.make_validators()
+
+    def _profile_call(self, func):
+        '''Call func, returning the result and the time spent in it less the
+        time charged to schemas it evaluated'''
+        self.profile_stack += [0.0]
+        start = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.profile_stack.pop()
+            if self.profile_stack:
+                self.profile_stack[-1] += elapsed
+
+        return result, elapsed - nested
+
+    def _get_profile_stats(self, schema_id):
+        return self.profile.setdefault(schema_id, {
+            'select': [0.0, 0],
+            'body': [0.0, 0],
+            'keywords': {},
+        })
+
+    def merge_profile(self, profile):
+        '''Add the profile from another DTValidator to this one'''
+        for schema_id, src in profile.items():
+            dst = self._get_profile_stats(schema_id)
+            for k in ['select', 'body']:
+                dst[k][0] += src[k][0]
+                dst[k][1] += src[k][1]
+            for k, v in src['keywords'].items():
+                kw_stats = dst['keywords'].setdefault(k, [0.0, 0])
+                kw_stats[0] += v[0]
+                kw_stats[1] += v[1]
+
+    def _iter_errors_profile(self, instance, filter, compatible_match):
+        for schema_id in self.get_schema_ids(instance, filter, compatible_match):
+            stats = self._get_profile_stats(schema_id)
+            schema = self.schemas[schema_id]
+            validator = self.get_validator(schema_id)
+
+            if 'select' in schema:
+                # Equivalent to the 'if' keyword of the wrapper schema
+                selected, elapsed = self._profile_call(
+                    lambda: validator.evolve(schema=schema['select']).is_valid(instance))
+                stats['select'][0] += elapsed
+                stats['select'][1] += 1
+                if not selected:
+                    continue
+                errors = validator.descend(instance, schema, schema_path='then')
+            else:
+                errors = validator.iter_errors(instance)
+
+            # The time is charged by keyword
+            errors = list(errors)
+            stats['body'][1] += 1
+
+            for error in errors:
                 self.annotate_error(schema_id, error)
                 yield error
 
@@ -472,15 +1345,26 @@ class DTValidator:
         for error in self.iter_errors(instance, filter=filter):
             raise error
 
-    def get_undocumented_compatibles(self, compatible_list):
-        undoc_compats = []
+    def _get_compatible_matcher(self, compatibles):
+        try:
+            return self.compatible_matchers[id(compatibles)][1]
+        except KeyError:
+            matcher = compatible_matcher.from_schema(compatibles)
+            self.compatible_matchers[id(compatibles)] = (compatibles, matcher)
+            return matcher
+
+    def _documented_compatible(self, validator, compatibles, instance, schema):
+        # The 'anyOf' errors are only needed if the matcher fails
+        if isinstance(instance, str) and self._get_compatible_matcher(compatibles).is_documented(instance):
+            return
+        yield from documentedCompatible(validator, compatibles, instance, schema)
 
-        validator = self.DtValidator(self.schemas['generated-compatibles'])
-        for compat in compatible_list:
-            if not validator.is_valid({"compatible": [compat]}):
-                undoc_compats += [compat]
+    def get_compatible_matcher(self):
+        sch = self.schemas['generated-compatibles']
+        return self._get_compatible_matcher(sch['properties']['compatible']['items']['documentedCompatible'])
 
-        return undoc_compats
+    def get_undocumented_compatibles(self, compatible_list):
+        return self.get_compatible_matcher().get_undocumented(compatible_list)
 
     def check_missing_property_types(self):
         for p, val in self.props.items():
@@ -561,32 +1445,10 @@ class DTValidator:
         return all_props
 
     def property_get_type(self, propname):
-        ptype = set()
-        if propname in self.props:
-            for v in self.props[propname]:
-                if v['type']:
-                    ptype.add(v['type'])
-        if len(ptype) == 0:
-            for v in self.pat_props.values():
-                if v[0]['type'] and v[0]['type'] not in ptype and v[0]['regex'].search(propname):
-                    ptype.add(v[0]['type'])
-
-        # Don't return 'node' as a type if there's other types
-        if len(ptype) > 1 and 'node' in ptype:
-            ptype -= {'node'}
-        return ptype
+        return set(self._lookup_property_type(propname)[0])
 
     def property_get_type_dim(self, propname):
-        if propname in self.props:
-            for v in self.props[propname]:
-                if 'dim' in v:
-                    return v['dim']
-
-        for v in self.pat_props.values():
-            if v[0]['type'] and 'dim' in v[0] and v[0]['regex'].search(propname):
-                return v[0]['dim']
-
-        return None
+        return self._lookup_property_type(propname)[1]
 
     def property_has_fixed_dimensions(self, propname):
         dim = self.property_get_type_dim(propname)
@@ -596,5 +1458,5 @@ class DTValidator:
 
         return False
 
-    def decode_dtb(self, dtb):
-        return [dtschema.dtb.fdt_unflatten(self, dtb)]
+    def decode_dtb(self, dtb, backend='libfdt', lazy=False, paths=None):
+        return [dtschema.dtb.fdt_unflatten(self, dtb, backend, lazy, paths)]
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Benchmarks for the Devicetree schema validation library
+#
+# Benchmarks are executed by running 'python3 test/bench-dt-validate.py' from
+# the top level directory of this repo. A synthetic set of schemas and a DTB
+# using them are generated, and the time taken by each phase of checking is
+# reported. With '-o FILE', the results are written as JSON which can be
+# given to '--compare' on a later run to show the change for each phase.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import libfdt
+
+import dtschema
+import dtschema.doc_validate
+import dtschema.validator
+
+schema_template = '''\
+# SPDX-License-Identifier: BSD-2-Clause
+%YAML 1.2
+---
+$id: http://devicetree.org/schemas/bench/bench-dev{n}.yaml#
+$schema: http://devicetree.org/meta-schemas/core.yaml#
+
+title: Synthetic benchmark device {n}
+
+maintainers:
+  - Rob Herring <robh@kernel.org>
+
+properties:
+  compatible:
+    enum:
+      - bench,dev{n}
+      - bench,dev{n}-v2
+
+  reg:
+    minItems: 1
+    maxItems: 2
+
+  interrupts:
+    maxItems: 1
+
+  clocks:
+    maxItems: 1
+
+  bench,mode:
+    description: A vendor property with a string value
+    $ref: /schemas/types.yaml#/definitions/string
+    enum: [ fast, slow ]
+
+  bench,values:
+    description: A vendor property with an array value
+    $ref: /schemas/types.yaml#/definitions/uint32-array
+    minItems: 1
+    maxItems: 8
+
+patternProperties:
+  "^bench,dev{n}-prop-[0-9]+$":
+    description: Vendor properties matching a pattern
+    $ref: /schemas/types.yaml#/definitions/uint32
+    maximum: 1000
+
+  "-dev{n}-supply$": true
+
+required:
+  - compatible
+  - reg
+
+additionalProperties: false
+'''
+
+board_schemas = {
+    'bench-board.yaml': '''\
+# SPDX-License-Identifier: BSD-2-Clause
+%YAML 1.2
+---
+$id: http://devicetree.org/schemas/bench/bench-board.yaml#
+$schema: http://devicetree.org/meta-schemas/core.yaml#
+
+title: Synthetic benchmark board
+
+maintainers:
+  - Rob Herring <robh@kernel.org>
+
+properties:
+  $nodename:
+    const: '/'
+
+  compatible:
+    const: bench,board
+
+additionalProperties: true
+''',
+
+    'bench-osc.yaml': '''\
+# SPDX-License-Identifier: BSD-2-Clause
+%YAML 1.2
+---
+$id: http://devicetree.org/schemas/bench/bench-osc.yaml#
+$schema: http://devicetree.org/meta-schemas/core.yaml#
+
+title: Synthetic benchmark oscillator
+
+maintainers:
+  - Rob Herring <robh@kernel.org>
+
+properties:
+  compatible:
+    const: bench,osc
+
+  '#clock-cells':
+    const: 0
+
+  clock-frequency: true
+
+required:
+  - compatible
+  - '#clock-cells'
+
+additionalProperties: false
+''',
+
+    'bench-intc.yaml': '''\
+# SPDX-License-Identifier: BSD-2-Clause
+%YAML 1.2
+---
+$id: http://devicetree.org/schemas/bench/bench-intc.yaml#
+$schema: http://devicetree.org/meta-schemas/core.yaml#
+
+title: Synthetic benchmark interrupt controller
+
+maintainers:
+  - Rob Herring <robh@kernel.org>
+
+properties:
+  compatible:
+    const: bench,intc
+
+  reg:
+    maxItems: 1
+
+  interrupt-controller: true
+
+  '#interrupt-cells':
+    const: 1
+
+  '#address-cells':
+    const: 0
+
+required:
+  - compatible
+  - reg
+  - interrupt-controller
+  - '#interrupt-cells'
+
+additionalProperties: false
+''',
+}
+
+
+def make_schemas(path, nr_schemas):
+    os.makedirs(os.path.join(path, 'bench'), exist_ok=True)
+
+    filenames = []
+    for name, schema in board_schemas.items():
+        filename = os.path.join(path, 'bench', name)
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(schema)
+        filenames += [filename]
+
+    for n in range(nr_schemas):
+        filename = os.path.join(path, 'bench', f'bench-dev{n}.yaml')
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(schema_template.format(n=n))
+        filenames += [filename]
+
+    return filenames
+
+
+def _u32s(*values):
+    return b''.join(v.to_bytes(4, 'big') for v in values)
+
+
+def make_dtb(nr_nodes, nr_schemas, nr_buses, depth, irq_map_size, nr_pattern_props):
+    '''Generate a DTB with nr_nodes devices spread over nr_buses chains of
+    nested simple-bus nodes depth levels deep'''
+    clk_phandle = 1
+    intc_phandle = 2
+
+    sw = libfdt.FdtSw()
+    sw.finish_reservemap()
+    sw.begin_node('')
+    sw.property_string('compatible', 'bench,board')
+    sw.property_string('model', 'Synthetic benchmark board')
+    sw.property_u32('#address-cells', 1)
+    sw.property_u32('#size-cells', 1)
+    sw.property_u32('interrupt-parent', intc_phandle)
+
+    sw.begin_node('clock-osc')
+    sw.property_string('compatible', 'bench,osc')
+    sw.property_u32('#clock-cells', 0)
+    sw.property_u32('clock-frequency', 24000000)
+    sw.property_u32('phandle', clk_phandle)
+    sw.end_node()
+
+    sw.begin_node('interrupt-controller@f0000000')
+    sw.property_string('compatible', 'bench,intc')
+    sw.property('reg', _u32s(0xf0000000, 0x1000))
+    sw.property('interrupt-controller', b'')
+    sw.property_u32('#interrupt-cells', 1)
+    sw.property_u32('#address-cells', 0)
+    sw.property_u32('phandle', intc_phandle)
+    sw.end_node()
+
+    node = 0
+    for bus in range(nr_buses):
+        for level in range(depth):
+            sw.begin_node(f'bus@{bus * 0x1000000 + level * 0x100000:x}')
+            sw.property_string('compatible', 'simple-bus')
+            sw.property_u32('#address-cells', 1)
+            sw.property_u32('#size-cells', 1)
+            sw.property('ranges', b'')
+
+        if bus == 0 and irq_map_size:
+            sw.property_u32('#interrupt-cells', 1)
+            sw.property('interrupt-map-mask', _u32s(0xfffff000, 0x3f))
+            sw.property('interrupt-map',
+                        b''.join(_u32s(i * 0x1000, i % 64, intc_phandle, i % 1024)
+                                 for i in range(irq_map_size)))
+
+        nr_bus_nodes = nr_nodes // nr_buses + (1 if bus < nr_nodes % nr_buses else 0)
+        for i in range(nr_bus_nodes):
+            n = node % nr_schemas
+            addr = bus * 0x1000000 + depth * 0x100000 + i * 0x1000
+            sw.begin_node(f'dev@{addr:x}')
+            sw.property_string('compatible', f'bench,dev{n}')
+            sw.property('reg', _u32s(addr, 0x1000))
+            sw.property_u32('interrupts', node % 1024)
+            sw.property_u32('clocks', clk_phandle)
+            sw.property_string('bench,mode', 'fast' if node % 2 else 'slow')
+            sw.property('bench,values', _u32s(*range(node % 8 + 1)))
+            for p in range(nr_pattern_props):
+                sw.property_u32(f'bench,dev{n}-prop-{p}', p)
+            sw.end_node()
+            node += 1
+
+        for level in range(depth):
+            sw.end_node()
+
+    sw.end_node()
+
+    return bytes(sw.as_fdt().as_bytearray())
+
+
+def get_nodes(nodename, subtree):
+    if not nodename.startswith('__'):
+        subtree['$nodename'] = [nodename]
+        yield subtree
+
+    for name, value in subtree.items():
+        if isinstance(value, dict):
+            yield from get_nodes(name, value)
+
+
+def bench(func, repeat):
+    '''Returns the fastest and mean time in seconds of calling func'''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times += [time.perf_counter() - start]
+
+    return {'min': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def bench_node_validation(validator, nodes):
+    for node in nodes:
+        for error in validator.iter_errors(node):
+            pass
+
+
+def run_benchmarks(args, workdir):
+    results = {}
+
+    schema_dir = os.path.join(workdir, 'schemas')
+    schema_files = make_schemas(schema_dir, args.schemas)
+
+    # Don't let a schema cache from other runs affect the results
+    cache_dir = os.path.join(workdir, 'cache')
+    dtschema.validator.schema_cache_dir = ''
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        results['process_schemas'] = bench(lambda: dtschema.validator.process_schemas([schema_dir]),
+                                           args.repeat)
+
+        dtschema.validator.schema_cache_dir = cache_dir
+        dtschema.validator.process_schemas([schema_dir])
+        results['process_schemas_cached'] = bench(lambda: dtschema.validator.process_schemas([schema_dir]),
+                                                  args.repeat)
+        dtschema.validator.schema_cache_dir = ''
+
+        validator = dtschema.DTValidator([schema_dir])
+
+    processed_json = os.path.join(workdir, 'processed-schema.json')
+    with open(processed_json, 'w', encoding='utf-8') as f:
+        json.dump(validator.schemas, f)
+    results['schema_load_json'] = bench(lambda: dtschema.DTValidator([processed_json]), args.repeat)
+
+    processed_bin = os.path.join(workdir, 'processed-schema.bin')
+    with open(processed_bin, 'wb') as f:
+        validator.save_snapshot(f)
+    results['schema_load_snapshot'] = bench(lambda: dtschema.DTValidator([processed_bin]), args.repeat)
+
+    dtb = make_dtb(args.nodes, args.schemas, args.buses, args.depth, args.irq_map, args.pattern_props)
+    results['fdt_unflatten'] = bench(lambda: validator.decode_dtb(dtb), args.repeat)
+    results['fdt_unflatten']['size'] = len(dtb)
+    results['fdt_unflatten_python'] = bench(lambda: validator.decode_dtb(dtb, 'python'), args.repeat)
+    results['fdt_unflatten_python']['size'] = len(dtb)
+    results['fdt_unflatten_lazy'] = bench(lambda: validator.decode_dtb(dtb, lazy=True), args.repeat)
+    results['fdt_unflatten_lazy']['size'] = len(dtb)
+
+    nodes = list(get_nodes('/', validator.decode_dtb(dtb)[0]))
+    results['node_validation'] = bench(lambda: bench_node_validation(validator, nodes), args.repeat)
+    results['node_validation']['nodes'] = len(nodes)
+
+    def check_docs():
+        for filename in schema_files:
+            dtschema.doc_validate.check_doc(filename)
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        results['doc_validate'] = bench(check_docs, args.repeat)
+    results['doc_validate']['files'] = len(schema_files)
+
+    # A mix of documented and undocumented compatibles
+    compatibles = [f'bench,dev{n}' for n in range(args.schemas)] + \
+                  [f'bench,undocumented{n}' for n in range(args.schemas)]
+    results['check_compatible'] = bench(lambda: validator.get_undocumented_compatibles(compatibles),
+                                        args.repeat)
+    results['check_compatible']['compatibles'] = len(compatibles)
+
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help="number of times to run each phase")
+    ap.add_argument('-n', '--nodes', type=int, default=2000,
+                    help="number of device nodes in the generated DTB")
+    ap.add_argument('-s', '--schemas', type=int, default=100,
+                    help="number of generated device schemas")
+    ap.add_argument('--buses', type=int, default=8,
+                    help="number of bus hierarchies the devices are spread over")
+    ap.add_argument('--depth', type=int, default=4,
+                    help="number of levels of nested buses")
+    ap.add_argument('--irq-map', type=int, default=1024,
+                    help="number of entries in the 'interrupt-map' of the first bus")
+    ap.add_argument('--pattern-props', type=int, default=4,
+                    help="number of properties matching a 'patternProperties' in each device")
+    ap.add_argument('-o', '--output', metavar='FILE',
+                    help="write the results as JSON to FILE")
+    ap.add_argument('--compare', metavar='FILE',
+                    help="show the change from the results in FILE from a prior run")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(args, workdir)
+
+    report = {
+        'version': dtschema.__version__,
+        'parameters': {k: getattr(args, k) for k in
+                       ['repeat', 'nodes', 'schemas', 'buses', 'depth', 'irq_map', 'pattern_props']},
+        'results': results,
+    }
+
+    old_results = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old_results = json.load(f)['results']
+
+    for phase, result in results.items():
+        line = f"{phase:24} {result['min'] * 1000:10.2f} ms (mean {result['mean'] * 1000:.2f} ms)"
+        if phase in old_results:
+            line += f" {result['min'] / old_results[phase]['min']:6.2f}x"
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,14 +12,19 @@ import unittest
 import os
 import copy
 import glob
+import json
 import sys
 import subprocess
 import tempfile
+import shutil
+import time
 
 basedir = os.path.dirname(__file__)
 import jsonschema
+import libfdt
 import ruamel.yaml
 import dtschema
+import dtschema.dtb2py
 
 dtschema_dir = os.path.dirname(dtschema.__file__)
 
@@ -140,6 +145,426 @@ class TestDTValidate(unittest.TestCase):
                 else:
                     self.assertIsNone(self.check_subtree('/', testtree[0]))
 
+    def test_snapshot(self):
+        '''Test that a processed schema snapshot loads the same schemas and tables'''
+        with tempfile.NamedTemporaryFile() as f:
+            self.validator.save_snapshot(f)
+            f.flush()
+            snapshot_validator = dtschema.DTValidator([f.name])
+
+        for attr in dtschema.validator.snapshot_attrs:
+            with self.subTest(attr=attr):
+                self.assertEqual(getattr(snapshot_validator, attr), getattr(self.validator, attr))
+
+    def test_pattern_index(self):
+        '''Test that the pattern property index finds the same types as searching every pattern'''
+        names = set(self.validator.props)
+        for name in list(names):
+            names |= {name + '-supply', name + '-names', 'vendor,' + name, name[1:], name + '\n'}
+
+        for name in names:
+            with self.subTest(name=name):
+                expected = [v[0] for v in self.validator.pat_props.values()
+                            if v[0]['type'] and v[0]['regex'].search(name)]
+                self.assertEqual(self.validator.get_pattern_types(name), expected)
+
+    def test_get_stride(self):
+        '''Test that the stride is the inner dimension of the smallest outer dimension which fits'''
+        for dim in [[[1, 4], [2, 3]], [[0, 8], [0, 8]], [[2, 2], [1, 16]], [[1, 1024], [1, 1024]], [[3, 5], [4, 4]]]:
+            for length in range(1, 64):
+                with self.subTest(dim=dim, length=length):
+                    matches = [inner for outer in range(dim[0][0], dim[0][1] + 1)
+                               for inner in range(dim[1][0], dim[1][1] + 1) if outer * inner == length]
+                    if matches:
+                        self.assertEqual(dtschema.dtb.get_stride(length, dim), matches[0])
+
+    def test_sized_array(self):
+        '''Test that values in a sized_array are sized_int of the array's size'''
+        array = dtschema.sized_array((1, 2, 0xffff), size=16)
+        self.assertEqual(array, [1, 2, 0xffff])
+        self.assertEqual([v.size for v in array], [16, 16, 16])
+        self.assertEqual(array[2].size, 16)
+        self.assertEqual(array[1:].size, 16)
+        self.assertEqual(copy.deepcopy(array).size, 16)
+        self.assertEqual(array.copy().size, 16)
+        self.assertEqual((array * 2).size, 16)
+        self.assertEqual((array + dtschema.sized_array([3], size=16)).size, 16)
+
+        # Concatenating values of other sizes keeps the size of each value
+        for values in [array + [3], array + dtschema.sized_array([3], size=8)]:
+            self.assertEqual([v.size for v in values[:3]], [16, 16, 16])
+        self.assertEqual([v.size for v in ([3] + array)[1:]], [16, 16, 16])
+        values = array.copy()
+        values += dtschema.sized_array([3], size=16)
+        self.assertEqual((values.size, values), (16, [1, 2, 0xffff, 3]))
+        values += [dtschema.sized_int(4, size=8)]
+        self.assertEqual([v.size for v in values], [16, 16, 16, 16, 8])
+
+        self.validator.DtValidator({'items': {'typeSize': 16}}).validate(array)
+        with self.assertRaises(jsonschema.ValidationError):
+            self.validator.DtValidator({'typeSize': 16}).validate(array)
+
+    def scan_dtb(self, dtb):
+        fdt = libfdt.Fdt(dtb)
+        ctx = dtschema.dtb.decode_context()
+        offset = fdt.first_subnode(-1, libfdt.QUIET_NOTFOUND)
+        return ctx, dtschema.dtb.fdt_scan_node(ctx, self.validator, fdt, '/', offset)
+
+    def sized_values(self, value):
+        if isinstance(value, dict):
+            return {k: self.sized_values(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.sized_values(v) for v in value]
+        if isinstance(value, dtschema.sized_int):
+            return (int(value), value.size)
+        return value
+
+    # Each fixup as a separate walk of the tree, as done before fixup_tree()
+
+    def fixup_phandles(self, ctx, dt, path=''):
+        for k, v in dt.items():
+            if isinstance(v, dict):
+                self.fixup_phandles(ctx, v, path=path + '/' + k)
+            else:
+                dt[k] = dtschema.dtb._fixup_phandle_prop(ctx, self.validator, path, k, v)
+
+    def fixup_gpios(self, ctx, dt):
+        if 'gpio-hog' in dt:
+            return
+        for k, v in dt.items():
+            if isinstance(v, dict):
+                self.fixup_gpios(ctx, v)
+            else:
+                dt[k] = dtschema.dtb._fixup_gpio_prop(ctx, k, v)
+
+    def fixup_interrupts(self, ctx, dt, icells):
+        icells = dtschema.dtb._fixup_interrupt_parent(ctx, dt, icells)
+
+        for k, v in dt.items():
+            if isinstance(v, dict):
+                if '#interrupt-cells' in dt:
+                    icells = dtschema.dtb._get_cells_size(dt, '#interrupt-cells')
+                self.fixup_interrupts(ctx, v, icells)
+            else:
+                dt[k] = dtschema.dtb._fixup_interrupt_prop(ctx, dt, k, v, icells)
+
+    def fixup_addresses(self, dt, ac, sc):
+        for k, v in dt.items():
+            if isinstance(v, dict):
+                if '#address-cells' in dt:
+                    ac = dtschema.dtb._get_cells_size(dt, '#address-cells')
+                if '#size-cells' in dt:
+                    sc = dtschema.dtb._get_cells_size(dt, '#size-cells')
+                self.fixup_addresses(v, ac, sc)
+            else:
+                dt[k] = dtschema.dtb._fixup_address_prop(self.validator, dt, k, v, ac, sc)
+
+    def test_fixup_tree(self):
+        '''Test that fixing up a tree in one walk is the same as each fixup in turn'''
+        for filename in glob.glob('test/*.dts') + glob.glob('test/fixups/*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+                ctx, expected = self.scan_dtb(res.stdout)
+                self.fixup_gpios(ctx, expected)
+                self.fixup_interrupts(ctx, expected, 1)
+                self.fixup_addresses(expected, 2, 1)
+                self.fixup_phandles(ctx, expected)
+
+                ctx, dt = self.scan_dtb(res.stdout)
+                dtschema.dtb.fixup_tree(ctx, self.validator, dt)
+
+                self.assertEqual(self.sized_values(dt), self.sized_values(expected))
+
+    def test_fdt_walk(self):
+        '''Test that walking the DTB directly decodes the same tree as libfdt'''
+        for filename in glob.glob('test/*.dts') + glob.glob('test/fixups/*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+                expected = self.validator.decode_dtb(res.stdout)
+                dt = self.validator.decode_dtb(res.stdout, 'python')
+                self.assertEqual(self.sized_values(dt), self.sized_values(expected))
+
+        with self.assertRaises(libfdt.FdtException):
+            self.validator.decode_dtb(b'\0' * 64, 'python')
+
+    def test_lazy_node(self):
+        '''Test that decoding properties on access gives the same tree as decoding up front'''
+        for filename in glob.glob('test/*.dts') + glob.glob('test/fixups/*.dts'):
+            for backend in ['libfdt', 'python']:
+                with self.subTest(schema=filename, backend=backend):
+                    res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                    self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+                    expected = self.validator.decode_dtb(res.stdout, backend)
+                    dt = self.validator.decode_dtb(res.stdout, backend, lazy=True)
+                    self.assertIsInstance(dt[0], dtschema.dtb.lazy_node)
+                    self.assertEqual(repr(dt), repr(expected))
+                    self.assertEqual(self.sized_values(dt), self.sized_values(expected))
+
+    def get_paths(self, path, subtree):
+        yield path
+        for name, value in subtree.items():
+            if isinstance(value, dict):
+                yield from self.get_paths(path.rstrip('/') + '/' + name, value)
+
+    def test_fdt_paths(self):
+        '''Test that decoding only the subtree at a path decodes it the same as the whole tree'''
+        for filename in glob.glob('test/*.dts') + glob.glob('test/fixups/*.dts'):
+            res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+            self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+            expected = self.validator.decode_dtb(res.stdout)[0]
+
+            for path in self.get_paths('/', expected):
+                for lazy in [False, True]:
+                    with self.subTest(schema=filename, path=path, lazy=lazy):
+                        dt = self.validator.decode_dtb(res.stdout, lazy=lazy, paths=[path])[0]
+                        node = dt
+                        expected_node = expected
+                        for name in path.split('/')[1:]:
+                            if not name:
+                                continue
+                            self.assertEqual(node.keys() - expected_node.keys(), set())
+                            node = node[name]
+                            expected_node = expected_node[name]
+                        self.assertEqual(self.sized_values(node), self.sized_values(expected_node))
+
+    def test_overlay(self):
+        '''Test that applying an overlay to a decoded base is the same as decoding the merged DTB'''
+        res = subprocess.run(['dtc', '-Odtb', 'test/overlays/base.dts'], capture_output=True)
+        self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+        base = dtschema.dtb.overlay_base(self.validator, res.stdout)
+        base_repr = repr(self.sized_values(base.dt))
+
+        for filename in glob.glob('test/overlays/overlay-*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+                fragments = dtschema.dtb.fdt_overlay_fragments(base, res.stdout)
+                expected = dtschema.dtb.fdt_merge_overlay(base, fragments)
+                dt = dtschema.dtb.fdt_apply_overlay(base, res.stdout)
+                # Compare reprs so the order of properties and nodes is checked too
+                self.assertEqual(repr(self.sized_values(dt)), repr(self.sized_values(expected)))
+                self.assertEqual(repr(self.sized_values(base.dt)), base_repr)
+
+        # Also check against a merged tree written out by hand. The order of
+        # properties and nodes there is only what dtc would do for the DTS.
+        res = subprocess.run(['dtc', '-Odtb', 'test/overlays/merged-devices.dts'], capture_output=True)
+        self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+        expected = self.validator.decode_dtb(res.stdout)[0]
+        res = subprocess.run(['dtc', '-Odtb', 'test/overlays/overlay-devices.dts'], capture_output=True)
+        self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+        dt = dtschema.dtb.fdt_apply_overlay(base, res.stdout)
+        self.assertEqual(self.sorted_nodes(self.sized_values(dt)), self.sorted_nodes(self.sized_values(expected)))
+
+    def sorted_nodes(self, value):
+        if isinstance(value, dict):
+            return sorted((k, self.sorted_nodes(v)) for k, v in value.items())
+        return value
+
+    def from_json(self, value):
+        if isinstance(value, dict):
+            if len(value) == 1 and next(iter(value)).startswith('$uint'):
+                size, value = next(iter(value.items()))
+                if isinstance(value, list):
+                    return [(v, int(size[5:])) for v in value]
+                return (value, int(size[5:]))
+            if len(value) == 1 and '$bytes' in value:
+                return bytes.fromhex(value['$bytes'])
+            return {k: self.from_json(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.from_json(v) for v in value]
+        if isinstance(value, int) and not isinstance(value, bool):
+            return (value, 32)
+        return value
+
+    def test_dtb2py_json(self):
+        '''Test that the JSON from dtb2py keeps the values and integer sizes'''
+        for filename in glob.glob('test/*.dts') + glob.glob('test/fixups/*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+                dt = self.validator.decode_dtb(res.stdout)[0]
+                value = json.loads(json.dumps(dtschema.dtb2py.to_json(dt)))
+                self.assertEqual(self.from_json(value), self.sized_values(dt))
+
+    def test_compatible_matcher(self):
+        '''Test that the compatible matcher, index and keyword match 'anyOf' the documented compatibles'''
+        matcher = self.validator.get_compatible_matcher()
+        with tempfile.NamedTemporaryFile('w') as f:
+            matcher.save(f)
+            f.flush()
+            self.assertTrue(dtschema.validator.is_compatible_index(f.name))
+            index = dtschema.validator.compatible_matcher.load(f.name)
+
+        sch = self.validator.schemas['generated-compatibles']['properties']['compatible']['items']
+        validator = self.validator.DtValidator({'anyOf': sch['documentedCompatible']})
+        keyword_validator = self.validator.DtValidator(sch)
+        compatibles = set(matcher.compatibles) | {'foo', 'foo\n', 'test,', 'vendor,unknown', ''}
+        for compatible in list(compatibles):
+            compatibles |= {compatible + 'x', 'x' + compatible, compatible[1:]}
+
+        for compatible in compatibles:
+            with self.subTest(compatible=compatible):
+                expected = validator.is_valid(compatible)
+                self.assertEqual(matcher.is_documented(compatible), expected)
+                self.assertEqual(index.is_documented(compatible), expected)
+                self.assertEqual([(e.message, [c.message for c in e.context])
+                                  for e in keyword_validator.iter_errors(compatible)],
+                                 [(e.message, [c.message for c in e.context])
+                                  for e in validator.iter_errors(compatible)])
+
+    def test_resolve_refs(self):
+        '''Test that linking $refs ahead of time gives the same errors, including recursive $refs'''
+        recursive = {
+            '$id': 'http://devicetree.org/schemas/recursive.yaml#',
+            'properties': {'child': {'$ref': '#'}},
+            'required': ['foo'],
+        }
+        instance = {'foo': True, 'child': {'foo': True, 'child': {'child': {}}}}
+        self.validator.schemas[recursive['$id']] = recursive
+        expected = [e.message for e in self.validator.DtValidator(recursive, resolver=self.validator.resolver).iter_errors(instance)]
+        self.assertEqual(len(expected), 2)
+
+        self.validator.resolve_refs()
+        with tempfile.NamedTemporaryFile() as f:
+            self.validator.save_snapshot(f)
+            f.flush()
+            validator = dtschema.DTValidator([f.name])
+
+        recursive = validator.schemas[recursive['$id']]
+        self.assertIsInstance(recursive['properties']['child']['$ref'], dtschema.validator.schema_ref)
+        self.assertIs(recursive['properties']['child']['$ref'].schema, recursive)
+        self.assertEqual([e.message for e in validator.DtValidator(recursive).iter_errors(instance)], expected)
+
+        for filename in glob.glob('test/*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+                for node in self.get_nodes('/', validator.decode_dtb(res.stdout)[0]):
+                    self.assertEqual([str(e) for e in validator.iter_errors(node)],
+                                     [str(e) for e in self.validator.iter_errors(node)])
+
+    def get_errors(self, schema, instances, nodes):
+        validator = self.validator.DtValidator(schema, resolver=self.validator.resolver)
+        errors = [e for instance in instances for e in validator.iter_errors(instance)]
+        errors += [e for node in nodes for e in self.validator.iter_errors(node)]
+        return [dtschema.format_error('test.dtb', e) for e in errors]
+
+    def test_optimize_schemas(self):
+        '''Test that optimizing the schemas doesn't change the errors'''
+        optimize = {
+            '$id': 'http://devicetree.org/schemas/optimize.yaml#',
+            'properties': {
+                'flatten': {'allOf': [{'allOf': [{'type': 'integer'}, {'maximum': 3}]}, True, {'minimum': 1}]},
+                'child': {'properties': {'foo': True, 'bar': {'const': 1}}},
+                'evaluated': {
+                    'allOf': [{'allOf': [{'properties': {'x': True}}, {'required': ['y']}]}],
+                    'unevaluatedProperties': False,
+                },
+                'pointer': {'$ref': '#/properties/child/properties/foo'},
+            },
+            'required': ['flatten'],
+        }
+        instances = [
+            {'flatten': 0, 'child': {'foo': 1, 'bar': 2}, 'evaluated': {'x': 1}, 'pointer': 1},
+            {'flatten': 'a', 'child': {'bar': 1}, 'evaluated': {'x': 1, 'y': 2}},
+            {'flatten': 4, 'evaluated': {'z': 1}},
+            {},
+        ]
+        nodes = []
+        for filename in glob.glob('test/*.dts'):
+            res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+            self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+            nodes += self.get_nodes('/', self.validator.decode_dtb(res.stdout)[0])
+
+        self.validator.schemas[optimize['$id']] = optimize
+        expected = self.get_errors(optimize, instances, nodes)
+
+        stats = self.validator.optimize_schemas()
+        for k, v in stats.items():
+            with self.subTest(stat=k):
+                self.assertGreater(v, 0)
+        self.assertEqual(optimize['properties']['flatten']['allOf'],
+                         [{'type': 'integer'}, {'maximum': 3}, {'minimum': 1}])
+        self.assertEqual(len(optimize['properties']['evaluated']['allOf'][0]['allOf']), 2)
+        self.assertIn('foo', optimize['properties']['child']['properties'])
+
+        self.validator.make_validators()
+        self.assertEqual(self.get_errors(optimize, instances, nodes), expected)
+
+    def get_nodes(self, nodename, subtree):
+        subtree['$nodename'] = [nodename]
+        yield subtree
+        for name, value in subtree.items():
+            if isinstance(value, dict):
+                yield from self.get_nodes(name, value)
+
+    def check_select_index(self, nodename, subtree):
+        subtree['$nodename'] = [nodename]
+        candidates = self.validator.get_select_schemas(subtree)
+        for schema_id in self.validator.always_schemas:
+            select = self.validator.schemas[schema_id]['select']
+            if self.validator.DtValidator(select, resolver=self.validator.resolver).is_valid(subtree):
+                self.assertIn(schema_id, candidates, msg=nodename)
+
+        for name, value in subtree.items():
+            if isinstance(value, dict):
+                self.check_select_index(name, value)
+
+    def test_server_reload(self):
+        '''Test that the validation server reloads a served schema directory when a schema changes'''
+        res = subprocess.run(['dtc', '-Odtb', 'test/device.dts'], capture_output=True)
+        self.assertEqual(res.returncode, 0, msg='dtc failed:\n' + res.stderr.decode())
+
+        dt_validate = [sys.executable, '-c', 'import sys, dtschema.dtb_validate; sys.exit(dtschema.dtb_validate.main())']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            schema_dir = os.path.join(tmpdir, 'schemas')
+            shutil.copytree(os.path.join(basedir, 'schemas'), schema_dir)
+            dtb = os.path.join(tmpdir, 'device.dtb')
+            with open(dtb, 'wb') as f:
+                f.write(res.stdout)
+            sock = os.path.join(tmpdir, 'sock')
+
+            server = subprocess.Popen(dt_validate + ['--serve', sock, '-s', schema_dir],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for i in range(600):
+                    if os.path.exists(sock):
+                        break
+                    time.sleep(0.1)
+
+                def connect():
+                    return subprocess.run(dt_validate + ['--connect', sock, '-s', schema_dir, dtb],
+                                          capture_output=True, text=True).stderr
+
+                self.assertNotIn('vendor,not-a-property', connect())
+
+                filename = os.path.join(schema_dir, 'good-example.yaml')
+                with open(filename, 'r', encoding='utf-8') as f:
+                    schema = f.read()
+                with open(filename, 'w', encoding='utf-8') as f:
+                    f.write(schema.replace('required:\n  - compatible\n',
+                                           'required:\n  - compatible\n  - vendor,not-a-property\n'))
+
+                self.assertIn("'vendor,not-a-property' is a required property", connect())
+            finally:
+                server.terminate()
+                server.wait()
+
+    def test_select_index(self):
+        '''Test that the select index finds every schema with a matching select'''
+        for filename in glob.iglob('test/*.dts'):
+            with self.subTest(schema=filename):
+                res = subprocess.run(['dtc', '-Odtb', filename], capture_output=True)
+                testtree = self.validator.decode_dtb(res.stdout)
+                self.check_select_index('/', testtree[0])
+
 
 
 if __name__ == '__main__':